@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import zipfile
+from multiprocessing import Pool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tokenizer')) # latency.py is shared with the tokenizer
+from latency import latency_summary, percentile
+
+MANIFEST_NAME = 'manifest.jsonl' # last member of the output archive: one entry per input line
+
+# manifest statuses
+DONE, FAILED = 'done', 'failed'
+
+WRITERS = ('music21', 'direct') # tokens_to_score + music21's exporter, or tokens_to_musicxml
+# rendered once when a writer is loaded, so that music21's lazy imports and caches are filled before the first real item
+WARMUP = 'R bar clef_treble key_sharp_1 time_3/4 note_G4 note_B4 len_1 stem_up note_C#5 len_1/2 stem_down beam_start note_D5 len_1/2 stem_down beam_stop rest len_1 ' \
+         'L bar clef_bass key_sharp_1 time_3/4 <voice> note_G2 len_3 </voice> <voice> rest len_1 note_D3 len_2 stem_down </voice>'
+
+detokenize = None
+
+# writer name -> function from a token sequence (string) to MusicXML text
+def load_writer(writer):
+    if writer == 'music21':
+        from music21.musicxml.m21ToXml import GeneralObjectExporter
+        from tokens_to_score import tokens_to_score
+        def to_musicxml(string):
+            return GeneralObjectExporter(tokens_to_score(string)).parse().decode('utf-8')
+        return to_musicxml
+    if writer == 'direct':
+        from tokens_to_musicxml import tokens_to_musicxml
+        return tokens_to_musicxml
+    raise ValueError(f'unknown writer: {writer}')
+
+# load (and warm up) the writer; called in the parent before the pool forks, and again in each worker (a no-op import there unless processes are spawned)
+def init_worker(writer='music21'):
+    global detokenize
+    detokenize = load_writer(writer)
+    try:
+        detokenize(WARMUP)
+    except Exception:
+        pass
+
+# worker: (index, name, token sequence) -> (index, name, status, MusicXML text, error, seconds)
+def detokenize_item(job):
+    index, name, string = job
+    start = time.perf_counter()
+    try:
+        xml, status, error = detokenize(string), DONE, None
+    except Exception as e: # one bad sequence must not stop the batch
+        xml, status, error = None, FAILED, f'{type(e).__name__}: {e}'
+    return index, name, status, xml, error, time.perf_counter() - start
+
+# lines of token sequences -> (line number, name, sequence); 'name<TAB>tokens' lines (as in shard files of batch_tokenize.py) keep their name
+def read_sequences(path):
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            name, _, tokens = line.rpartition('\t')
+            yield number, name or None, tokens
+
+# archive member of an item: line number, then the name (if any) made safe for a file name
+def member_name(number, name):
+    if not name:
+        return f'{number:06d}.musicxml'
+    stem = os.path.basename(name.split('::')[-1])
+    stem = re.sub(r'(\.musicxml|\.xml|\.mxl)(\.gz)?$', '', stem)
+    stem = re.sub(r'[^\w.-]+', '_', stem)
+    return f'{number:06d}_{stem}.musicxml'
+
+# detokenize every sequence of a file into MusicXML members of one zip archive, written as results arrive (in input order); failures are recorded in the manifest member
+def detokenize_batch(in_path, out_path, workers=None, writer='music21', log_every=1000, log=sys.stderr):
+    init_worker(writer) # forked workers start with the writer imported and warmed up
+    counts, latencies = {DONE: 0, FAILED: 0}, []
+    tmp_path = out_path + '.tmp'
+    start = time.perf_counter()
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as archive, Pool(workers, initializer=init_worker, initargs=(writer,)) as pool:
+        manifest = []
+        for i, (number, name, status, xml, error, seconds) in enumerate(pool.imap(detokenize_item, read_sequences(in_path), chunksize=4), 1):
+            entry = {'line': number, 'name': name, 'status': status, 'seconds': round(seconds, 4)}
+            if status == DONE:
+                entry['member'] = member_name(number, name)
+                archive.writestr(entry['member'], xml)
+            else:
+                entry['error'] = error
+            manifest.append(json.dumps(entry, ensure_ascii=False) + '\n')
+            counts[status] += 1
+            latencies.append(seconds)
+            if log_every and i % log_every == 0:
+                print(f'{i} sequences, {i / (time.perf_counter() - start):.1f} sequences/s', file=log)
+        archive.writestr(MANIFEST_NAME, ''.join(manifest))
+    os.replace(tmp_path, out_path) # only complete archives get the final name
+
+    elapsed = time.perf_counter() - start
+    print(f'{counts[DONE]} done, {counts[FAILED]} failed in {elapsed:.1f} s ({len(latencies) / elapsed if elapsed else 0:.1f} sequences/s)', file=log)
+    print(f'per-item latency: {latency_summary(latencies, "items")}', file=log)
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Detokenize a file of token sequences (one per line) into MusicXML members of a zip archive, with a pool of warm workers.')
+    parser.add_argument('input', help="token sequences, one per line ('name<TAB>tokens' lines keep their name)")
+    parser.add_argument('-o', '--out', required=True, help=f'output zip archive (MusicXML members and {MANIFEST_NAME})')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--writer', choices=WRITERS, default='music21', help='tokens_to_score + music21 (default), or the direct writer of tokens_to_musicxml.py')
+    parser.add_argument('--log-every', type=int, default=1000, help='report progress every N sequences')
+    args = parser.parse_args(argv)
+
+    counts = detokenize_batch(args.input, args.out, args.workers, args.writer, args.log_every)
+    return 1 if counts[FAILED] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
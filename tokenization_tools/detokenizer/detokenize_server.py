@@ -0,0 +1,227 @@
+import argparse
+import functools
+import itertools
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing import Pool, TimeoutError
+
+from batch_detokenize import DONE, FAILED, WRITERS, detokenize_item, init_worker, percentile
+
+BUSY = 'busy' # status of requests rejected while max_pending requests are in the pool
+LATENCY_WINDOW = 10000 # latest requests the percentiles are computed over
+PERCENTILES = (0.5, 0.9, 0.99)
+
+# protocol: one JSON object per line in both directions
+#   {"tokens": "R bar ..."} (or a bare token line) -> {"status": "done", "musicxml": "...", "seconds": ...} / {"status": "failed" or "busy", "error": "..."}
+#   {"command": "stats"} -> counters, queue depth and latency percentiles
+
+# latency percentiles in milliseconds
+def percentiles(seconds, qs=PERCENTILES):
+    seconds = sorted(seconds)
+    if not seconds:
+        return {}
+    summary = {f'p{round(q * 100)}': round(percentile(seconds, q) * 1e3, 2) for q in qs}
+    summary['max'] = round(seconds[-1] * 1e3, 2)
+    return summary
+
+# worker pool behind the server; requests beyond max_pending in the pool are rejected at once instead of queueing up
+class DetokenizeService:
+    def __init__(self, workers=None, writer='music21', max_pending=None, timeout=60.0, max_tasks_per_child=None):
+        init_worker(writer) # forked workers start with the writer imported and warmed up
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = Pool(self.workers, initializer=init_worker, initargs=(writer,), maxtasksperchild=max_tasks_per_child)
+        self.max_pending = max_pending or 4 * self.workers
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.requests = itertools.count()
+        self.in_pool = set() # requests whose slot is taken
+        self.done = self.failed = self.rejected = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW) # request received -> response ready
+        self.start = time.perf_counter()
+
+    @property
+    def pending(self):
+        return len(self.in_pool)
+
+    def release(self, request, _=None): # free the slot of a request: when its worker finishes, or when it times out (its worker may have died, and then no callback comes); later calls are no-ops
+        with self.lock:
+            self.in_pool.discard(request)
+
+    def detokenize(self, string): # -> response
+        start = time.perf_counter()
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return {'status': BUSY, 'error': f'{self.pending} requests pending, retry later'}
+            request = next(self.requests)
+            self.in_pool.add(request)
+        release = functools.partial(self.release, request) # also the pool callbacks
+        result = self.pool.apply_async(detokenize_item, ((0, None, string),), callback=release, error_callback=release)
+        try:
+            _, _, status, xml, error, seconds = result.get(self.timeout)
+        except TimeoutError:
+            status, xml, error, seconds = FAILED, None, f'no result in {self.timeout} s', None
+            release()
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+            if status == DONE:
+                self.done += 1
+            else:
+                self.failed += 1
+        if status == DONE:
+            return {'status': DONE, 'musicxml': xml, 'seconds': round(seconds, 4)}
+        return {'status': FAILED, 'error': error}
+
+    def stats(self):
+        with self.lock:
+            return {'workers': self.workers, 'pending': self.pending, 'max_pending': self.max_pending,
+                    'done': self.done, 'failed': self.failed, 'rejected': self.rejected,
+                    'uptime': round(time.perf_counter() - self.start, 1), 'latency_ms': percentiles(self.latencies)}
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+class RequestHandler(socketserver.StreamRequestHandler): # requests of one connection, answered in order
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode('utf-8').strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line) if line.startswith('{') else {'tokens': line}
+                if not isinstance(request, dict):
+                    raise ValueError('not a JSON object')
+                if request.get('command') == 'stats':
+                    response = self.server.service.stats()
+                else:
+                    response = self.server.service.detokenize(request['tokens'])
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'status': FAILED, 'error': f'bad request: {type(e).__name__}: {e}'}
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+# address: a socket path, or (host, port)
+def make_server(address, service):
+    if isinstance(address, str):
+        if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode): # left by a killed server
+            os.remove(address)
+        server = UnixServer(address, RequestHandler)
+    else:
+        server = TCPServer(address, RequestHandler)
+    server.service = service
+    return server
+
+# client keeping one connection to a server
+class DetokenizeClient:
+    def __init__(self, address, timeout=None):
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        self.socket.connect(address)
+        self.file = self.socket.makefile('rwb')
+
+    def send(self, request): # -> response
+        self.file.write(json.dumps(request, ensure_ascii=False).encode('utf-8') + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('connection closed by the server')
+        return json.loads(line)
+
+    def detokenize(self, string): # -> MusicXML text; ValueError for sequences that fail, RuntimeError when the server is busy
+        response = self.send({'tokens': string})
+        if response['status'] == DONE:
+            return response['musicxml']
+        raise (RuntimeError if response['status'] == BUSY else ValueError)(response['error'])
+
+    def stats(self):
+        return self.send({'command': 'stats'})
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+def serve(address, service, log=sys.stderr):
+    server = make_server(address, service)
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    print(f'serving on {address} with {service.workers} workers (at most {service.max_pending} pending requests)', file=log)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+        print(json.dumps(service.stats()), file=log)
+
+def add_address_arguments(parser):
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--socket', help='Unix domain socket path')
+    group.add_argument('--port', type=int, help='TCP port')
+    parser.add_argument('--host', default='127.0.0.1', help='TCP host (default: 127.0.0.1)')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Long-lived detokenization server: token sequences in, MusicXML out, over a Unix domain socket or a local TCP port.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_ = commands.add_parser('serve', help='run the server')
+    serve_.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    serve_.add_argument('--writer', choices=WRITERS, default='music21', help='tokens_to_score + music21 (default), or the direct writer of tokens_to_musicxml.py')
+    serve_.add_argument('--max-pending', type=int, default=None, help='requests in the pool beyond which new ones are rejected as busy (default: 4 per worker)')
+    serve_.add_argument('--timeout', type=float, default=60.0, help='seconds a request waits for its result (default: 60)')
+    serve_.add_argument('--max-tasks-per-child', type=int, default=None, help='replace workers after this many requests (default: never)')
+    request = commands.add_parser('request', help='detokenize the first token sequence of a file (or stdin) through a server')
+    request.add_argument('input', nargs='?', default='-')
+    request.add_argument('-o', '--out', default='-', help='MusicXML output file (default: stdout)')
+    stats = commands.add_parser('stats', help="print a server's counters, queue depth and latency percentiles")
+    for command in (serve_, request, stats):
+        add_address_arguments(command)
+    args = parser.parse_args(argv)
+
+    address = args.socket if args.socket else (args.host, args.port)
+    if args.command == 'serve':
+        serve(address, DetokenizeService(args.workers, args.writer, args.max_pending, args.timeout, args.max_tasks_per_child))
+        return 0
+
+    client = DetokenizeClient(address)
+    try:
+        if args.command == 'stats':
+            print(json.dumps(client.stats(), indent=1))
+            return 0
+        f = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+        with f:
+            string = f.readline().strip()
+        response = client.send({'tokens': string})
+    finally:
+        client.close()
+    if response['status'] != DONE:
+        print(f"{response['status']}: {response['error']}", file=sys.stderr)
+        return 1
+    if args.out == '-':
+        sys.stdout.write(response['musicxml'])
+    else:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(response['musicxml'])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
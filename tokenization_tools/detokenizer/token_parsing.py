@@ -0,0 +1,62 @@
+# music21-free helpers on token sequences, shared by tokens_to_score and tokens_to_musicxml
+
+# aggregate note(rest)-related tokens
+def aggr_note_token(tokens):
+    notes, others, out = [], [], []
+    note_flag, len_flag = False, False
+
+    for t in tokens:
+        parts = t.split('_')
+        if parts[0] in ('note', 'rest'):
+            if note_flag and len_flag and len(notes):
+                out.append(' '.join(notes))
+                notes = []
+            note_flag = True
+            len_flag = False
+            notes.append(t)
+        elif parts[0] == 'len':
+            len_flag = True
+            notes.append(t)
+        elif parts[0] in ('stem', 'beam', 'tie'):
+            notes.append(t)
+        else: # other than note-related
+            if len(notes):
+                out.append(' '.join(notes))
+                notes = []
+            out.append(t)
+
+    # buffer flush
+    if len(notes):
+        out.append(' '.join(notes))
+
+    return out
+
+def concatenated_to_regular(tokens):
+    regular_tokens = []
+    for t in tokens:
+        if t.startswith('len') or t.startswith('attr'):
+            attrs = t.split('_')
+            if len(attrs) == 2:
+                regular_tokens.append(f'len_{attrs[1]}')
+            elif len(attrs) == 3:
+                regular_tokens += [f'len_{attrs[1]}', f'stem_{attrs[2]}']
+            else:
+                regular_tokens += [f'len_{attrs[1]}', f'stem_{attrs[2]}', f'beam_{"_".join(attrs[3:])}']
+        else:
+            regular_tokens.append(t)
+    return regular_tokens
+
+def merged_to_regular(tokens): # expand learned compound tokens ('len_1/2+stem_up+beam_continue', see token_merges.py)
+    return [t for merged in tokens for t in merged.split('+')]
+
+def split_R_L(string):
+    tokens = string.split()
+    tokens = concatenated_to_regular(merged_to_regular(tokens))
+    
+    if 'L' in tokens:
+        R = ' '.join(tokens[tokens.index('R')+1:tokens.index('L')])
+        L = ' '.join(tokens[tokens.index('L')+1:])
+    else:
+        R = ' '.join(tokens[tokens.index('R')+1:])
+        L = ''
+    return R, L
\ No newline at end of file
@@ -0,0 +1,335 @@
+import functools
+import math
+import re
+import zipfile
+from collections import namedtuple
+from fractions import Fraction
+
+from token_parsing import aggr_note_token, split_R_L
+
+# notated values (in quarter notes), longest first
+NOTE_TYPES = [(Fraction(16), 'long'), (Fraction(8), 'breve'), (Fraction(4), 'whole'), (Fraction(2), 'half'), (Fraction(1), 'quarter'), (Fraction(1, 2), 'eighth'),
+              (Fraction(1, 4), '16th'), (Fraction(1, 8), '32nd'), (Fraction(1, 16), '64th'), (Fraction(1, 32), '128th'), (Fraction(1, 64), '256th')]
+MAX_DOTS = 3
+
+CLEFS = {'treble': ('G', 2), 'bass': ('F', 4)}
+BEAM_VALUES = {'start': 'begin', 'stop': 'end', 'continue': 'continue', 'partial-right': 'forward hook', 'partial-left': 'backward hook'}
+TIE_TYPES = {'start': ('start',), 'stop': ('stop',), 'continue': ('stop', 'start')} # <tie> / <tied> types
+ACCIDENTALS = {-2: 'flat-flat', -1: 'flat', 0: 'natural', 1: 'sharp', 2: 'double-sharp'}
+SHARP_ORDER, FLAT_ORDER = 'FCGDAEB', 'BEADGCF'
+
+# MIDI number spelling of tokens_to_score: music21's default names, respelled with flats / sharps in flat / sharp keys
+DEFAULT_NAMES = [('C', 0), ('C', 1), ('D', 0), ('E', -1), ('E', 0), ('F', 0), ('F', 1), ('G', 0), ('G', 1), ('A', 0), ('B', -1), ('B', 0)]
+FLAT_NAMES = [('C', 0), ('D', -1), ('D', 0), ('E', -1), ('E', 0), ('F', 0), ('G', -1), ('G', 0), ('A', -1), ('A', 0), ('B', -1), ('B', 0)]
+SHARP_NAMES = [('C', 0), ('C', 1), ('D', 0), ('D', 1), ('E', 0), ('F', 0), ('F', 1), ('G', 0), ('G', 1), ('A', 0), ('A', 1), ('B', 0)]
+
+NOTE_NAME = re.compile(r'([A-G])(#{1,2}|b{1,2}|)(-?\d+)$')
+
+# one <note> (or several, for chords) of a staff measure; pitches are (step, alter, octave), empty for rests
+Written = namedtuple('Written', ['offset', 'voice', 'pitches', 'accidentals', 'length', 'type', 'dots', 'tuplet', 'bracket', 'stem', 'beams', 'ties'])
+# a clef, key or time signature: kind in ('key', 'time', 'clef')
+Signature = namedtuple('Signature', ['offset', 'voice', 'kind', 'value'])
+
+# translate a note token (name or MIDI number) into (step, alter, octave), spelled as tokens_to_score does
+def token_to_pitch(name, fifths=0):
+    if name.isdecimal():
+        number = int(name)
+        names = FLAT_NAMES if fifths < 0 else SHARP_NAMES if fifths > 0 else DEFAULT_NAMES
+        step, alter = names[number % 12]
+        return step, alter, number // 12 - 1
+    match = NOTE_NAME.match(name)
+    if match is None:
+        raise ValueError(f'unknown note name: {name}')
+    step, accidental, octave = match.groups()
+    return step, accidental.count('#') - accidental.count('b'), int(octave)
+
+def key_alters(fifths): # step -> alter of a key signature
+    if fifths >= 0:
+        return {step: 1 for step in SHARP_ORDER[:fifths]}
+    return {step: -1 for step in FLAT_ORDER[:-fifths]}
+
+def signature_value(token): # clef / key / time token -> (kind, value), None for clefs other than treble and bass
+    parts = token.split('_')
+    if parts[0] == 'clef':
+        return ('clef', CLEFS[parts[1]]) if parts[1] in CLEFS else None
+    if parts[0] == 'key':
+        return 'key', {'sharp': 1, 'flat': -1, 'natural': 0}[parts[1]] * int(parts[2])
+    if '/' in parts[1]:
+        beats, beat_type = parts[1].split('/')
+        return 'time', (int(beats), int(beat_type))
+    return 'time', (int(parts[1]), 4 if int(parts[1]) < 6 else 8)
+
+# split a length into notated values: [(length, type, dots), ...] (tied in the score) and the tuplet ratio (actual, normal) or None
+def split_length(length):
+    actual = length.denominator
+    while actual % 2 == 0:
+        actual //= 2
+    normal = 1 << (actual.bit_length() - 1) # 3:2, 5:4, 7:4, ...
+    value = length * actual / normal
+    parts = []
+    while value > 0:
+        base, type_ = next(((base, type_) for base, type_ in NOTE_TYPES if base <= value), NOTE_TYPES[-1])
+        dotted, dots = base, 0
+        while dots < MAX_DOTS and dotted + base / 2 ** (dots + 1) <= value:
+            dots += 1
+            dotted += base / 2 ** dots
+        parts.append((min(dotted, value) * normal / actual, type_, dots))
+        value -= dotted
+    return parts, (actual, normal) if actual > 1 else None
+
+def split_ties(tie, count): # ties of the 'count' tied values a length with 'tie' is notated with
+    if count == 1:
+        return [tie]
+    first = 'start' if tie in (None, 'start') else 'continue'
+    last = 'stop' if tie in (None, 'stop') else 'continue'
+    return [first] + ['continue'] * (count - 2) + [last]
+
+class StaffReader: # token groups of one staff -> measures of Written / Signature items, with offsets as tokens_to_score places them
+    def __init__(self, first_voice=1):
+        self.first_voice = first_voice
+        self.fifths = 0
+        self.measures, self.items = [], []
+        self.max_voices = 1
+        self.tuplets = {} # voice -> (index of the first item, length so far) of an open tuplet bracket
+
+    def read(self, tokens):
+        groups = aggr_note_token(tokens)
+        for i, group in enumerate(groups):
+            if group == 'bar':
+                self.new_measure()
+            elif not self.measures: # tokens before the first 'bar'
+                raise ValueError(f'token before the first bar: {group}')
+            elif group == '<voice>':
+                if self.voice is None:
+                    if self.voice_start is None:
+                        self.voice_start = self.position
+                    self.voice = self.first_voice + self.voice_count
+                    self.voice_count += 1
+                    self.max_voices = max(self.max_voices, self.voice_count)
+                    self.position = self.voice_start
+            elif group == '</voice>':
+                if self.voice is not None:
+                    self.voice_ends.append(self.position)
+                    self.voice = None
+                    ends = sorted(self.voice_ends)
+                    self.position = ends[-2] if len(ends) > 1 else ends[-1] # where the tokenizer's post-voice section starts
+            elif group.split('_')[0] in ('clef', 'key', 'time'):
+                if group.startswith('key_natural') and i + 1 < len(groups) and groups[i + 1].split('_')[0] == 'key':
+                    continue # as tokens_to_score: consecutive key signatures keep the last one (MuseScore workaround)
+                value = signature_value(group)
+                if value is not None:
+                    self.items.append(Signature(self.position, self.current_voice(), *value))
+                    if value[0] == 'key':
+                        self.fifths = value[1]
+                        self.alters = {}
+            elif group[:4] in ('note', 'rest'):
+                self.add_group(group.split())
+        self.close_tuplets()
+        return self.measures
+
+    def new_measure(self):
+        self.close_tuplets()
+        self.items = []
+        self.measures.append(self.items)
+        self.position = Fraction(0)
+        self.voice, self.voice_start, self.voice_count, self.voice_ends = None, None, 0, []
+        self.alters = {} # (step, octave) -> alter shown last in this measure
+
+    def current_voice(self):
+        return self.voice if self.voice is not None else self.first_voice
+
+    def add_group(self, tokens): # one note / chord / rest group, as note_token_to_obj reads it
+        kinds = [t.split('_')[0] for t in tokens]
+        lengths = [Fraction(t.split('_')[1]) for t, kind in zip(tokens, kinds) if kind == 'len']
+        if not lengths:
+            raise ValueError(f"no length in '{' '.join(tokens)}'")
+        if tokens[0] == 'rest':
+            parts, tuplet = split_length(lengths[0])
+            for length, type_, dots in parts:
+                self.add(Written(self.position, self.current_voice(), (), (), length, type_, dots, tuplet, None, None, (), ()))
+            return
+
+        pitches = [token_to_pitch(t.split('_')[1], self.fifths) for t, kind in zip(tokens, kinds) if kind == 'note']
+        stems = [t.split('_')[1] for t, kind in zip(tokens, kinds) if kind in ('stem', 'dir')]
+        beams = [t.split('_')[1:] for t, kind in zip(tokens, kinds) if kind == 'beam']
+        ties = [t.split('_')[1] for t, kind in zip(tokens, kinds) if kind == 'tie']
+        for i, length in enumerate(lengths):
+            if len(lengths) == 1:
+                tie = ties[0] if ties else None
+            else: # tied chain, as in note_token_to_obj
+                tie = 'continue' if ties or 0 < i < len(lengths) - 1 else 'start' if i == 0 else 'stop'
+            parts, tuplet = split_length(length)
+            for (part, type_, dots), part_tie in zip(parts, split_ties(tie, len(parts))):
+                self.add(Written(self.position, self.current_voice(), pitches, self.accidentals(pitches, part_tie), part, type_, dots, tuplet, None,
+                                 stems[0] if stems else None, tuple(BEAM_VALUES.get(b, b) for b in beams[0]) if beams else (), TIE_TYPES.get(part_tie, ())))
+
+    def accidentals(self, pitches, tie): # accidentals to show: an alter differing from the last one shown on this step and octave in the measure, or from the key
+        shown = []
+        for step, alter, octave in pitches:
+            expected = self.alters.get((step, octave), key_alters(self.fifths).get(step, 0))
+            shown.append(ACCIDENTALS.get(alter) if alter != expected and tie not in ('stop', 'continue') else None)
+            self.alters[(step, octave)] = alter
+        return tuple(shown)
+
+    def add(self, written):
+        voice = written.voice
+        if written.tuplet is None:
+            self.close_tuplet(voice)
+        else: # brackets run until the tuplet notes add up to a regular length again
+            first, total = self.tuplets.get(voice, (len(self.items), Fraction(0)))
+            total += written.length
+            if (total.denominator & (total.denominator - 1)) == 0:
+                if first == len(self.items):
+                    written = written._replace(bracket=('start', 'stop'))
+                else:
+                    self.items[first] = self.items[first]._replace(bracket=('start',))
+                    written = written._replace(bracket=('stop',))
+                self.tuplets.pop(voice, None)
+            else:
+                self.tuplets[voice] = (first, total)
+        self.items.append(written)
+        self.position += written.length
+
+    def close_tuplet(self, voice): # an incomplete tuplet: bracket from its first to its last note
+        if voice in self.tuplets:
+            first, _ = self.tuplets.pop(voice)
+            last = max(i for i, item in enumerate(self.items) if type(item) is Written and item.voice == voice and item.tuplet is not None)
+            self.items[first] = self.items[first]._replace(bracket=('start',) if first != last else ('start', 'stop'))
+            if first != last:
+                self.items[last] = self.items[last]._replace(bracket=('stop',))
+
+    def close_tuplets(self):
+        for voice in list(self.tuplets):
+            self.close_tuplet(voice)
+
+def signature_xml(kind, value, number=None):
+    attribute = f' number="{number}"' if number is not None else ''
+    if kind == 'key':
+        return f'<key{attribute}><fifths>{value}</fifths></key>'
+    if kind == 'time':
+        return f'<time{attribute}><beats>{value[0]}</beats><beat-type>{value[1]}</beat-type></time>'
+    return f'<clef{attribute}><sign>{value[0]}</sign><line>{value[1]}</line></clef>'
+
+ATTRIBUTE_ORDER = {'key': 0, 'time': 1, 'staves': 2, 'clef': 3}
+
+def attributes_xml(signatures, divisions=None, staves=None): # signatures: [(kind, value, staff), ...]; a key / time signature set alike on every staff is written once
+    parts = [] if staves is None else [(ATTRIBUTE_ORDER['staves'], 0, f'<staves>{staves}</staves>')]
+    values = {}
+    for kind, value, staff in signatures:
+        values.setdefault(kind, {})[staff] = value
+    for kind, by_staff in values.items():
+        if kind != 'clef' and len(by_staff) == (staves or 2) and len(set(by_staff.values())) == 1:
+            parts.append((ATTRIBUTE_ORDER[kind], 0, signature_xml(kind, next(iter(by_staff.values())))))
+        else:
+            parts += [(ATTRIBUTE_ORDER[kind], staff, signature_xml(kind, value, staff)) for staff, value in by_staff.items()]
+    return '<attributes>' + (f'<divisions>{divisions}</divisions>' if divisions is not None else '') + ''.join(xml for _, _, xml in sorted(parts)) + '</attributes>'
+
+def note_xml(written, divisions, staff):
+    duration = int(written.length * divisions)
+    lines = []
+    pitches = written.pitches[::-1] or [None] # the tokenizer reads chord notes back in reverse order
+    accidentals = written.accidentals[::-1]
+    for k, pitch in enumerate(pitches):
+        parts = ['<note>']
+        if k:
+            parts.append('<chord/>')
+        if pitch is None:
+            parts.append('<rest/>')
+        else:
+            step, alter, octave = pitch
+            parts.append(f'<pitch><step>{step}</step>' + (f'<alter>{alter}</alter>' if alter else '') + f'<octave>{octave}</octave></pitch>')
+        parts.append(f'<duration>{duration}</duration>')
+        parts += [f'<tie type="{tie}"/>' for tie in written.ties]
+        parts.append(f'<voice>{written.voice}</voice><type>{written.type}</type>' + '<dot/>' * written.dots)
+        if pitch is not None and accidentals[k]:
+            parts.append(f'<accidental>{accidentals[k]}</accidental>')
+        if written.tuplet is not None:
+            parts.append(f'<time-modification><actual-notes>{written.tuplet[0]}</actual-notes><normal-notes>{written.tuplet[1]}</normal-notes></time-modification>')
+        if written.stem is not None and pitch is not None:
+            parts.append(f'<stem>{written.stem}</stem>')
+        parts.append(f'<staff>{staff}</staff>')
+        if k == 0:
+            parts += [f'<beam number="{level}">{value}</beam>' for level, value in enumerate(written.beams, 1)]
+        notations = [f'<tied type="{tie}"/>' for tie in written.ties]
+        if k == 0 and written.bracket:
+            notations += [f'<tuplet type="{bracket}"' + (' bracket="yes"' if bracket == 'start' else '') + '/>' for bracket in written.bracket]
+        if notations:
+            parts.append('<notations>' + ''.join(notations) + '</notations>')
+        parts.append('</note>')
+        lines.append(''.join(parts))
+    return lines
+
+def iter_musicxml(string): # token sequence (string) -> MusicXML text, chunk by chunk
+    R_str, L_str = split_R_L(string)
+    right = StaffReader(1)
+    right_measures = right.read(R_str.split())
+    left = StaffReader(right.max_voices + 1) # voice numbers are unique in the part, as with voice_numbering in tokens_to_score
+    staves = [right_measures, left.read(L_str.split())]
+
+    lengths = {item.length for measures in staves for items in measures for item in items if type(item) is Written}
+    divisions = functools.reduce(lambda a, b: a * b // math.gcd(a, b), (length.denominator for length in lengths), 1) # least common multiple (math.lcm needs Python 3.9)
+
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" "http://www.musicxml.org/dtds/partwise.dtd">\n'
+           '<score-partwise version="4.0">\n'
+           '<identification><encoding><supports element="accidental" type="yes"/><supports element="beam" type="yes"/><supports element="stem" type="yes"/></encoding></identification>\n'
+           '<part-list><score-part id="P1"><part-name/></score-part></part-list>\n'
+           '<part id="P1">\n')
+    measure_count = max(len(measures) for measures in staves)
+    for number in range(measure_count):
+        lines = [f'<measure number="{number + 1}">']
+        # signatures at the start of each staff go into one <attributes> (with <divisions> and <staves> in the first measure)
+        leading, bodies = [], []
+        for staff, measures in enumerate(staves, 1):
+            items = measures[number] if number < len(measures) else []
+            k = 0
+            while k < len(items) and type(items[k]) is Signature and items[k].offset == 0:
+                leading.append((items[k].kind, items[k].value, staff))
+                k += 1
+            bodies.append(items[k:])
+        if number == 0:
+            lines.append(attributes_xml(leading, divisions, len(staves)))
+        elif leading:
+            lines.append(attributes_xml(leading))
+
+        position = Fraction(0)
+        for staff, items in enumerate(bodies, 1):
+            for item in items:
+                if item.offset != position: # <backup> / <forward> to the item
+                    shift = int(abs(item.offset - position) * divisions)
+                    lines.append(f"<{'backup' if item.offset < position else 'forward'}><duration>{shift}</duration></{'backup' if item.offset < position else 'forward'}>")
+                    position = item.offset
+                if type(item) is Signature:
+                    lines.append(attributes_xml([(item.kind, item.value, staff)]))
+                else:
+                    lines += note_xml(item, divisions, staff)
+                    position += item.length
+            if staff < len(bodies) and position:
+                lines.append(f'<backup><duration>{int(position * divisions)}</duration></backup>')
+                position = Fraction(0)
+        if number == measure_count - 1:
+            lines.append('<barline location="right"><bar-style>regular</bar-style></barline>')
+        lines.append('</measure>\n')
+        yield '\n'.join(lines)
+    yield '</part>\n</score-partwise>\n'
+
+# build MusicXML text from a token sequence (string), without music21
+def tokens_to_musicxml(string):
+    return ''.join(iter_musicxml(string))
+
+MXL_CONTAINER = ('<?xml version="1.0" encoding="UTF-8"?>\n<container><rootfiles><rootfile full-path="{}" media-type="application/vnd.recordare.musicxml+xml"/></rootfiles></container>\n')
+
+# write a token sequence (string) into a MusicXML file, or a compressed MusicXML file if the path ends with '.mxl'
+def write_musicxml(string, path):
+    if path.endswith('.mxl'):
+        name = 'score.musicxml'
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(zipfile.ZipInfo('mimetype'), 'application/vnd.recordare.musicxml', compress_type=zipfile.ZIP_STORED)
+            archive.writestr('META-INF/container.xml', MXL_CONTAINER.format(name))
+            with archive.open(name, 'w') as f:
+                for chunk in iter_musicxml(string):
+                    f.write(chunk.encode('utf-8'))
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            for chunk in iter_musicxml(string):
+                f.write(chunk)
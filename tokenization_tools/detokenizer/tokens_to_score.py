@@ -1,5 +1,7 @@
 from music21 import *
 
+from token_parsing import aggr_note_token, concatenated_to_regular, split_R_L
+
 # dictionary to change note names
 sharp_to_flat = {'C#': 'D-', 'D#': 'E-', 'F#': 'G-', 'G#': 'A-', 'A#': 'B-'}
 flat_to_sharp = {v:k for k, v in sharp_to_flat.items()}
@@ -18,37 +20,6 @@ def pitch_to_name(pitch_, key=key.KeySignature(0)):
     else:
         return pitch_.replace('b', '-')
 
-# aggregate note(rest)-related tokens
-def aggr_note_token(tokens):
-    notes, others, out = [], [], []
-    note_flag, len_flag = False, False
-
-    for t in tokens:
-        parts = t.split('_')
-        if parts[0] in ('note', 'rest'):
-            if note_flag and len_flag and len(notes):
-                out.append(' '.join(notes))
-                notes = []
-            note_flag = True
-            len_flag = False
-            notes.append(t)
-        elif parts[0] == 'len':
-            len_flag = True
-            notes.append(t)
-        elif parts[0] in ('stem', 'beam', 'tie'):
-            notes.append(t)
-        else: # other than note-related
-            if len(notes):
-                out.append(' '.join(notes))
-                notes = []
-            out.append(t)
-
-    # buffer flush
-    if len(notes):
-        out.append(' '.join(notes))
-
-    return out
-
 # translate clef or signature token into music21 object
 def single_token_to_obj(token):
     parts = token.split('_')
@@ -233,21 +204,6 @@ def tokens_to_PartStaff(tokens, key_=0, start_voice=1):
 
     return p
 
-def concatenated_to_regular(tokens):
-    regular_tokens = []
-    for t in tokens:
-        if t.startswith('len') or t.startswith('attr'):
-            attrs = t.split('_')
-            if len(attrs) == 2:
-                regular_tokens.append(f'len_{attrs[1]}')
-            elif len(attrs) == 3:
-                regular_tokens += [f'len_{attrs[1]}', f'stem_{attrs[2]}']
-            else:
-                regular_tokens += [f'len_{attrs[1]}', f'stem_{attrs[2]}', f'beam_{"_".join(attrs[3:])}']
-        else:
-            regular_tokens.append(t)
-    return regular_tokens
-
 # build music21 Score object from a token sequnece (string)
 def tokens_to_score(string, voice_numbering=False):
     R_str, L_str = split_R_L(string)
@@ -268,16 +224,4 @@ def tokens_to_score(string, voice_numbering=False):
     s = stream.Score()
     g = layout.StaffGroup([r, l], symbol='brace', barTogether=True)
     s.append([g, r, l])
-    return s
-
-def split_R_L(string):
-    tokens = string.split()
-    tokens = concatenated_to_regular(tokens)
-    
-    if 'L' in tokens:
-        R = ' '.join(tokens[tokens.index('R')+1:tokens.index('L')])
-        L = ' '.join(tokens[tokens.index('L')+1:])
-    else:
-        R = ' '.join(tokens[tokens.index('R')+1:])
-        L = ''
-    return R, L
\ No newline at end of file
+    return s
\ No newline at end of file
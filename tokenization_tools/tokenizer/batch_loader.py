@@ -0,0 +1,199 @@
+import argparse
+import bisect
+import queue
+import sys
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from packed_corpus import PackedCorpus
+
+MAX_LENGTH = 1024 # tokens per row
+PAD_MULTIPLE = 8 # rows are padded to the longest one, rounded up to this
+
+Batch = namedtuple('Batch', ['ids', 'lengths', 'segments', 'examples']) # (B, L) padded IDs, (B,) tokens per row, (B, L) example number in the row (from 1; 0 for separators and padding), example indices of each row
+
+def build_length_index(corpus, max_length=MAX_LENGTH): # (n, 4) int64 [sequence, first measure, end measure, length] of the examples of a packed corpus
+    # whole sequences up to max_length tokens (measures -1, -1); longer ones are cut at barlines into windows of whole measures, each staff starting with its section token
+    sections = len(corpus.staff_names)
+    lengths = np.diff(np.asarray(corpus.sequences))
+    whole = np.flatnonzero(lengths <= max_length)
+    examples = [np.stack([whole, np.full(len(whole), -1), np.full(len(whole), -1), lengths[whole]], axis=1)]
+    for i in np.flatnonzero(lengths > max_length):
+        widths = measure_widths(corpus, i)
+        ends = np.concatenate([[0], np.cumsum(widths)])
+        start = 0
+        while start < len(widths):
+            end = int(np.searchsorted(ends, ends[start] + max_length - sections, side='right')) - 1
+            if end <= start: # a measure that alone exceeds the limit is left out
+                start += 1
+                continue
+            examples.append(np.array([[i, start, end, sections + ends[end] - ends[start]]]))
+            start = end
+    return np.concatenate(examples).astype(np.int64)
+
+def measure_widths(corpus, i): # tokens of measure j of sequence i, over all its staves
+    counts = corpus.staff_measures[i, :, 1] - corpus.staff_measures[i, :, 0]
+    widths = np.zeros(counts.max() if len(counts) else 0, dtype=np.int64)
+    for (first, end), count in zip(corpus.staff_measures[i], counts):
+        widths[:count] += corpus.measures[first:end, 1] - corpus.measures[first:end, 0]
+    return widths
+
+def example_ids(corpus, sequence, start, end): # token IDs of an example of the length index
+    if start < 0:
+        return corpus[sequence]
+    parts = []
+    for s, (first, last) in enumerate(corpus.staff_measures[sequence]):
+        if corpus.staff_names:
+            section = corpus.staves[sequence, s, 0]
+            parts.append(corpus.tokens[section:section + 1])
+        a, b = first + min(start, last - first), first + min(end, last - first)
+        if a < b:
+            parts.append(corpus.tokens[corpus.measures[a, 0]:corpus.measures[b - 1, 1]])
+    return np.concatenate(parts)
+
+def pack_examples(lengths, max_length=MAX_LENGTH): # best-fit decreasing: [[example index, ...], ...] rows of at most max_length tokens, one separator between examples
+    rows, free = [], [] # free: sorted (free tokens, row)
+    for e in np.argsort(-np.asarray(lengths), kind='stable').tolist():
+        need = int(lengths[e]) + 1
+        k = bisect.bisect_left(free, (need, -1))
+        if k < len(free):
+            space, row = free.pop(k)
+            rows[row].append(e)
+            space -= need
+        else:
+            row, space = len(rows), max_length - int(lengths[e])
+            rows.append([e])
+        if space > 1:
+            bisect.insort(free, (space, row))
+    return rows
+
+class LoaderStats: # padding efficiency and throughput of a loader
+    def __init__(self):
+        self.batches = self.rows = self.tokens = self.cells = 0
+        self.build_seconds = self.wait_seconds = 0.0
+        self.start = time.perf_counter()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        return (f'{self.batches} batches, {self.rows} rows, padding efficiency {self.tokens / max(self.cells, 1):.1%}; '
+                f'built {self.tokens / max(self.build_seconds, 1e-9):,.0f} tokens/s ({self.batches / max(elapsed, 1e-9):.1f} batches/s), consumer waited {self.wait_seconds:.2f} s of {elapsed:.2f} s')
+
+class BatchLoader: # length-bucketed batches of a packed corpus, built in a background thread
+    def __init__(self, corpus, max_length=MAX_LENGTH, batch_size=16, pack=True, separator=None, bucket_batches=64, prefetch=4, pad_multiple=PAD_MULTIPLE, seed=0, index=None, dtype=np.int32):
+        self.corpus = PackedCorpus(corpus) if isinstance(corpus, str) else corpus
+        self.max_length, self.batch_size, self.bucket_batches, self.prefetch, self.pad_multiple, self.dtype = max_length, batch_size, bucket_batches, prefetch, pad_multiple, dtype
+        self.pad_id = self.corpus.vocabulary.pad_id
+        self.separator = separator if separator is not None else len(self.corpus.vocabulary) # by default a new ID after the vocabulary
+        self.index = index if index is not None else build_length_index(self.corpus, max_length)
+        lengths = self.index[:, 3]
+        self.rows = pack_examples(lengths, max_length) if pack else [[e] for e in range(len(lengths))]
+        self.row_lengths = np.array([lengths[row].sum() + len(row) - 1 for row in self.rows], dtype=np.int64)
+        self.rng = np.random.default_rng(seed)
+        self.stats = LoaderStats()
+
+    def __len__(self): # batches per epoch
+        return -(-len(self.rows) // self.batch_size)
+
+    def plan(self): # one epoch: [[row, ...], ...]; rows are shuffled, sorted by length within buckets of bucket_batches batches, and the batches shuffled
+        order = self.rng.permutation(len(self.rows))
+        bucket = self.batch_size * self.bucket_batches
+        batches = []
+        for b in range(0, len(order), bucket):
+            rows = order[b:b + bucket]
+            rows = rows[np.argsort(self.row_lengths[rows], kind='stable')]
+            batches += [rows[k:k + self.batch_size] for k in range(0, len(rows), self.batch_size)]
+        return [batches[k] for k in self.rng.permutation(len(batches))]
+
+    def build(self, rows): # -> Batch
+        start = time.perf_counter()
+        lengths = self.row_lengths[rows]
+        width = -(-int(lengths.max()) // self.pad_multiple) * self.pad_multiple
+        ids = np.full((len(rows), width), self.pad_id, dtype=self.dtype)
+        segments = np.zeros((len(rows), width), dtype=np.int32)
+        examples = []
+        for r, row in enumerate(rows):
+            position = 0
+            for k, e in enumerate(self.rows[row]):
+                if k:
+                    ids[r, position] = self.separator
+                    position += 1
+                tokens = example_ids(self.corpus, *self.index[e, :3])
+                ids[r, position:position + len(tokens)] = tokens
+                segments[r, position:position + len(tokens)] = k + 1
+                position += len(tokens)
+            examples.append(self.rows[row])
+        self.stats.build_seconds += time.perf_counter() - start
+        self.stats.batches += 1
+        self.stats.rows += len(rows)
+        self.stats.tokens += int(lengths.sum())
+        self.stats.cells += ids.size
+        return Batch(ids, lengths, segments, examples)
+
+    def __iter__(self): # one epoch; batches are built ahead in a thread, at most 'prefetch' of them waiting
+        batches, stop = queue.Queue(self.prefetch), threading.Event()
+        def produce():
+            try:
+                for rows in self.plan():
+                    if stop.is_set():
+                        return
+                    batches.put(self.build(rows))
+            except Exception as e:
+                batches.put(e)
+            else:
+                batches.put(None)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                batch = batches.get()
+                self.stats.wait_seconds += time.perf_counter() - start
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally: # the consumer stopped early: unblock and end the thread
+            stop.set()
+            while thread.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+def padding_efficiency(lengths, batches, pad_multiple=PAD_MULTIPLE): # tokens / cells of batches (lists of row indices) of rows of 'lengths' tokens
+    cells = sum(len(rows) * -(-int(lengths[rows].max()) // pad_multiple) * pad_multiple for rows in batches)
+    return lengths.sum() / max(cells, 1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Length-bucketed, prefetching batches of token IDs from a packed corpus; reports padding efficiency and loader throughput.')
+    parser.add_argument('corpus', help='packed corpus directory (packed_corpus.py)')
+    parser.add_argument('--max-length', type=int, default=MAX_LENGTH, help=f'tokens per row (default: {MAX_LENGTH})')
+    parser.add_argument('-b', '--batch-size', type=int, default=16, help='rows per batch (default: 16)')
+    parser.add_argument('--no-pack', action='store_true', help='one example per row')
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--step-seconds', type=float, default=0.0, help='simulated training step per batch, to measure stalls (default: 0)')
+    parser.add_argument('--prefetch', type=int, default=4, help='batches built ahead (default: 4)')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    loader = BatchLoader(args.corpus, args.max_length, args.batch_size, not args.no_pack, prefetch=args.prefetch)
+    print(f'{len(loader.index)} examples in {len(loader.rows)} rows, indexed in {time.perf_counter() - start:.2f} s', file=sys.stderr)
+    lengths = loader.index[:, 3]
+    shuffled = np.random.default_rng(0).permutation(len(lengths))
+    baseline = [shuffled[k:k + args.batch_size] for k in range(0, len(lengths), args.batch_size)]
+    print(f'padding efficiency of shuffled unpacked batches: {padding_efficiency(lengths, baseline):.1%}', file=sys.stderr)
+
+    loader.stats = LoaderStats()
+    for _ in range(args.epochs):
+        for _ in loader:
+            time.sleep(args.step_seconds)
+    print(loader.stats.report(), file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
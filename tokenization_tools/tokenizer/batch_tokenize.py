@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import sys
+import time
+import zipfile
+from multiprocessing import Pool
+
+from latency import latency_summary
+from score_to_tokens import UnsupportedScore, stream_MusicXML_to_tokens
+from token_cache import TokenCache
+
+SCORE_EXTENSIONS = ('.musicxml', '.xml', '.mxl', '.musicxml.gz', '.xml.gz')
+CORPUS_ARCHIVE_EXTENSIONS = ('.zip',)
+MEMBER_SEPARATOR = '::' # 'corpus.zip::path/in/archive.musicxml'
+MANIFEST_NAME = 'manifest.jsonl'
+
+# manifest statuses
+DONE, FAILED, SKIPPED = 'done', 'failed', 'skipped'
+
+def find_scores(inputs): # files, directories (searched recursively) and zip archives of scores -> sorted score paths
+    paths = []
+    for input_ in inputs:
+        if os.path.isdir(input_):
+            for root, _, files in os.walk(input_):
+                paths += [os.path.join(root, f) for f in files if f.lower().endswith(SCORE_EXTENSIONS + CORPUS_ARCHIVE_EXTENSIONS)]
+        else:
+            paths.append(input_)
+
+    scores = []
+    for path in set(os.path.normpath(p) for p in paths):
+        if path.lower().endswith(CORPUS_ARCHIVE_EXTENSIONS):
+            scores += archive_scores(path)
+        else:
+            scores.append(path)
+    return sorted(scores)
+
+def archive_scores(archive_path): # members of a corpus zip that are scores, as 'archive::member'
+    with zipfile.ZipFile(archive_path) as archive:
+        names = [i.filename for i in archive.infolist() if not i.is_dir()]
+    return [archive_path + MEMBER_SEPARATOR + name for name in names
+            if name.lower().endswith(SCORE_EXTENSIONS) and not name.startswith(('META-INF/', '__MACOSX/'))]
+
+cache = None # per worker process, see init_worker
+
+def init_worker(cache_dir=None, cache_bytes=None):
+    global cache
+    cache = TokenCache(cache_dir, cache_bytes) if cache_dir else None
+
+def tokenize_score(path, note_name=True, tokenize=None): # path or 'archive::member'; members are streamed from the archive
+    if tokenize is None:
+        tokenize = cache.tokenize if cache is not None else stream_MusicXML_to_tokens
+    if MEMBER_SEPARATOR in path:
+        archive_path, member = path.split(MEMBER_SEPARATOR, 1)
+        with zipfile.ZipFile(archive_path) as archive, archive.open(member) as f:
+            return tokenize(f, note_name=note_name)
+    return tokenize(path, note_name=note_name)
+
+def tokenize_file(job): # worker: (path, note_name) -> (path, status, tokens, error, seconds)
+    path, note_name = job
+    start = time.perf_counter()
+    try:
+        tokens = tokenize_score(path, note_name)
+        status, error = DONE, None
+    except UnsupportedScore as e: # other errors (malformed scores included) are failures, retried with --retry-failed
+        tokens, status, error = None, SKIPPED, str(e)
+    except Exception as e:
+        tokens, status, error = None, FAILED, f'{type(e).__name__}: {e}'
+    return path, status, tokens, error, time.perf_counter() - start
+
+def read_manifest(out_dir): # path -> latest manifest entry
+    entries = {}
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # line cut off by a killed run
+                    continue
+                entries[entry['path']] = entry
+    return entries
+
+class ShardWriter: # token lines go to 'shard-XXXXX.txt.tmp' and are committed (renamed + recorded in the manifest) together
+    def __init__(self, out_dir, shard_size):
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        self.manifest = open(os.path.join(out_dir, MANIFEST_NAME), 'a', encoding='utf-8')
+        for f in os.listdir(out_dir): # leftovers of a killed run; their pieces are not in the manifest
+            if f.endswith('.tmp'):
+                os.remove(os.path.join(out_dir, f))
+        shards = [int(f[6:11]) for f in os.listdir(out_dir) if f.startswith('shard-') and f.endswith('.txt')]
+        self.next_shard = max(shards) + 1 if shards else 0
+        self.file, self.pending = None, []
+
+    def shard_name(self):
+        return f'shard-{self.next_shard:05d}.txt'
+
+    def write(self, path, tokens, seconds):
+        if self.file is None:
+            self.file = open(os.path.join(self.out_dir, self.shard_name() + '.tmp'), 'w', encoding='utf-8')
+        self.file.write(path + '\t' + ' '.join(map(str, tokens)) + '\n')
+        self.pending.append({'path': path, 'status': DONE, 'shard': self.shard_name(), 'line': len(self.pending), 'tokens': len(tokens), 'seconds': round(seconds, 4)})
+        if len(self.pending) >= self.shard_size:
+            self.commit()
+
+    def record(self, path, status, error, seconds): # failed / skipped inputs have no shard
+        self.write_manifest([{'path': path, 'status': status, 'error': error, 'seconds': round(seconds, 4)}])
+
+    def commit(self):
+        if self.file is None:
+            return
+        self.file.close()
+        os.replace(self.file.name, os.path.join(self.out_dir, self.shard_name()))
+        self.write_manifest(self.pending)
+        self.file, self.pending = None, []
+        self.next_shard += 1
+
+    def write_manifest(self, entries):
+        self.manifest.write(''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in entries))
+        self.manifest.flush()
+        os.fsync(self.manifest.fileno())
+
+    def close(self):
+        self.commit()
+        self.manifest.close()
+
+def tokenize_corpus(inputs, out_dir, workers=None, shard_size=1000, note_name=True, retry_failed=False, log_every=1000, cache_dir=None, cache_bytes=1 << 30, log=sys.stderr):
+    os.makedirs(out_dir, exist_ok=True)
+    finished = read_manifest(out_dir)
+    redo = (FAILED,) if retry_failed else ()
+    paths = [p for p in find_scores(inputs) if p not in finished or finished[p]['status'] in redo]
+    print(f'{len(paths)} files to tokenize ({len(finished)} already in the manifest)', file=log)
+
+    counts = {DONE: 0, FAILED: 0, SKIPPED: 0}
+    latencies = []
+    writer = ShardWriter(out_dir, shard_size)
+    start = time.perf_counter()
+    try:
+        with Pool(workers, initializer=init_worker, initargs=(cache_dir, cache_bytes)) as pool:
+            for i, (path, status, tokens, error, seconds) in enumerate(pool.imap_unordered(tokenize_file, [(p, note_name) for p in paths], chunksize=4), 1):
+                if status == DONE:
+                    writer.write(path, tokens, seconds)
+                else:
+                    writer.record(path, status, error, seconds)
+                counts[status] += 1
+                latencies.append(seconds)
+                if log_every and i % log_every == 0:
+                    print(f'{i}/{len(paths)} files, {i / (time.perf_counter() - start):.1f} files/s', file=log)
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"{counts[DONE]} done, {counts[FAILED]} failed, {counts[SKIPPED]} skipped in {elapsed:.1f} s ({len(latencies) / elapsed if elapsed else 0:.1f} files/s)", file=log)
+    print(f'per-file latency: {latency_summary(latencies)}', file=log)
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Tokenize a corpus of MusicXML scores into sharded token files.')
+    parser.add_argument('inputs', nargs='+', help='score files (.musicxml, .xml, .mxl, .gz), directories (searched recursively) or zip archives of scores')
+    parser.add_argument('-o', '--out-dir', required=True, help=f'output directory for shards and {MANIFEST_NAME}')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--shard-size', type=int, default=1000, help='pieces per shard file')
+    parser.add_argument('--midi-number', action='store_true', help='emit MIDI note numbers instead of note names')
+    parser.add_argument('--retry-failed', action='store_true', help='tokenize inputs recorded as failed again')
+    parser.add_argument('--log-every', type=int, default=1000, help='report progress every N files')
+    parser.add_argument('--cache-dir', default=None, help='reuse tokens of unchanged scores from this on-disk cache')
+    parser.add_argument('--cache-size', type=int, default=1024, help='cache size limit in MB (least recently used entries are evicted)')
+    args = parser.parse_args(argv)
+
+    counts = tokenize_corpus(args.inputs, args.out_dir, args.workers, args.shard_size, not args.midi_number, args.retry_failed, args.log_every, args.cache_dir, args.cache_size << 20)
+    return 1 if counts[FAILED] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+from lxml import etree
+
+from score_to_tokens import MusicXML_to_tokens, collapse_chords, index_measure, lxml_measure_to_elements, measure_elements_to_tokens, segment_elements, stream_MusicXML_to_tokens
+from synthetic_scores import synthetic_piano_score
+from vocabulary import default_vocabulary
+
+PHASES = ('parse', 'extract', 'collapse', 'segment', 'emit', 'emit_ids', 'stream_total', 'soup_total')
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# (measures, voices per staff, chord density, staff crossing): one axis varied at a time around the first case
+CASES = [(200, 2, 0.3, 0.1),
+         (50, 2, 0.3, 0.1), (800, 2, 0.3, 0.1),
+         (200, 1, 0.3, 0.1), (200, 4, 0.3, 0.1),
+         (200, 2, 0.0, 0.1), (200, 2, 0.8, 0.1),
+         (200, 2, 0.3, 0.0), (200, 2, 0.3, 0.4)]
+
+def case_name(measures, voices, chord_density, staff_crossing):
+    return f'm{measures}_v{voices}_c{chord_density}_x{staff_crossing}'
+
+def best_of(repeat, func): # minimum wall time of 'repeat' runs, and the last result
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def time_phases(data, repeat=3): # seconds per phase of the tokenization pipeline for one score (bytes)
+    timings = {}
+    timings['parse'], root = best_of(repeat, lambda: etree.fromstring(data))
+    measures = root.findall('part/measure')
+    timings['extract'], elements = best_of(repeat, lambda: [lxml_measure_to_elements(m) for m in measures])
+    staves = (1, 2)
+    timings['collapse'], elements = best_of(repeat, lambda: [collapse_chords(e, staves) for e in elements])
+    timings['segment'], indexes = best_of(repeat, lambda: [(index, [segment_elements(index, staff) for staff in staves]) for index in map(index_measure, elements)])
+
+    def emit(vocabulary=None): # includes the split of each measure into sections, given the prebuilt index
+        divisions = [0, 0]
+        for measure_elements, (index, _) in zip(elements, indexes):
+            for i, staff in enumerate(staves):
+                _, divisions[i] = measure_elements_to_tokens(measure_elements, staff, divisions[i], True, index, vocabulary)
+    timings['emit'], _ = best_of(repeat, emit)
+    vocabulary = default_vocabulary()
+    timings['emit_ids'], _ = best_of(repeat, lambda: emit(vocabulary))
+
+    timings['stream_total'], tokens = best_of(repeat, lambda: stream_MusicXML_to_tokens(data))
+    timings['soup_total'], soup_tokens = best_of(repeat, lambda: MusicXML_to_tokens(data))
+    assert tokens == soup_tokens, 'backends disagree'
+    return timings
+
+def run_benchmarks(cases=CASES, repeat=3, seed=0, log=sys.stdout):
+    results = {}
+    for case in cases:
+        name = case_name(*case)
+        data = synthetic_piano_score(*case, seed=seed).encode('utf-8')
+        results[name] = time_phases(data, repeat)
+        print(f'{name:28s} ' + ' '.join(f'{phase} {results[name][phase] * 1e3:8.2f} ms' for phase in PHASES), file=log)
+    return results
+
+def find_regressions(results, baseline, threshold=0.2): # (case, phase, baseline seconds, seconds) slower than baseline by more than 'threshold'
+    regressions = []
+    for name, timings in results.items():
+        for phase, seconds in timings.items():
+            base = baseline.get(name, {}).get(phase)
+            if base and seconds > base * (1 + threshold):
+                regressions.append((name, phase, base, seconds))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the tokenizer on synthetic piano scores and compare with a stored baseline.')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline timings (JSON)')
+    parser.add_argument('--save-baseline', action='store_true', help='store the timings of this run as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='flag phases slower than the baseline by more than this fraction')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per phase (the fastest is kept)')
+    parser.add_argument('--quick', action='store_true', help='only the first (central) case')
+    parser.add_argument('--ci', action='store_true', help='fail (exit status 1) when there is no baseline to compare with, instead of only reporting it')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(CASES[:1] if args.quick else CASES, args.repeat)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print(f'baseline saved to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'no baseline at {args.baseline} (run with --save-baseline first)')
+        return 1 if args.ci else 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = find_regressions(results, baseline, args.threshold)
+    for name, phase, base, seconds in regressions:
+        print(f'REGRESSION {name} {phase}: {base * 1e3:.2f} ms -> {seconds * 1e3:.2f} ms (+{(seconds / base - 1) * 100:.0f}%)')
+    print(f'{len(regressions)} regressions (threshold {args.threshold * 100:.0f}%)')
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
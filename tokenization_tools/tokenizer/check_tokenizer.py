@@ -0,0 +1,101 @@
+import argparse
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+from parallel_tokenize import measure_parallel_MusicXML_to_tokens, parallel_MusicXML_to_tokens
+from score_to_tokens import TOKENIZER_VERSION, MusicXML_to_tokens, stream_MusicXML_to_tokens
+from synthetic_scores import synthetic_piano_score
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_SCORE, SAMPLE_TOKENS = os.path.join(HERE, 'sample', 'input_score.musicxml'), os.path.join(HERE, 'sample', 'generated_tokens.txt')
+DEFAULT_EXPECTED = os.path.join(HERE, 'check_tokenizer_expected.json') # TOKENIZER_VERSION and digests of the token sequences of the original MusicXML_to_tokens
+
+# synthetic scores: every combination of (voices per staff, chord density, staff crossing), 'SEEDS' scores each
+MEASURES, SEEDS = 32, 2
+CASES = list(itertools.product((1, 2, 3, 4), (0.0, 0.3, 0.8), (0.0, 0.1, 0.4)))
+
+def backends(pool): # name -> function from (score bytes, note_name) to tokens; all must give the tokens of MusicXML_to_tokens
+    return {'soup': MusicXML_to_tokens,
+            'stream': stream_MusicXML_to_tokens,
+            'parts': lambda data, note_name: parallel_MusicXML_to_tokens(data, note_name, pool=pool),
+            'ranges': lambda data, note_name: measure_parallel_MusicXML_to_tokens(data, note_name, workers=4, pool=pool, min_measures=8)}
+
+def digest(tokens):
+    return hashlib.sha1(' '.join(tokens).encode('utf-8')).hexdigest()
+
+def synthetic_scores(): # (name, score bytes)
+    for (voices, chord_density, staff_crossing), seed in itertools.product(CASES, range(SEEDS)):
+        yield f'm{MEASURES}_v{voices}_c{chord_density}_x{staff_crossing}_s{seed}', synthetic_piano_score(MEASURES, voices, chord_density, staff_crossing, seed).encode('utf-8')
+
+def expected_digests(tokenize=MusicXML_to_tokens): # name -> digest of the tokens of each synthetic score, with and without note names
+    return {f'{name}_{"name" if note_name else "midi"}': digest(tokenize(data, note_name)) for name, data in synthetic_scores() for note_name in (True, False)}
+
+def check(expected, workers=None, log=sys.stdout): # (backend, score) pairs whose tokens differ from the expected ones
+    mismatches = []
+    with open(SAMPLE_SCORE, 'rb') as f:
+        sample = f.read()
+    with open(SAMPLE_TOKENS, encoding='utf-8') as f:
+        sample_tokens = f.read().split()
+    with contextlib.ExitStack() as stack:
+        pool = stack.enter_context(Pool(workers))
+        for backend, tokenize in backends(pool).items():
+            checked = 0
+            if tokenize(sample, True) != sample_tokens:
+                mismatches.append((backend, 'sample'))
+            for name, data in synthetic_scores():
+                for note_name in (True, False):
+                    key = f'{name}_{"name" if note_name else "midi"}'
+                    if key in expected:
+                        checked += 1
+                        if digest(tokenize(data, note_name)) != expected[key]:
+                            mismatches.append((backend, key))
+            print(f'{backend:8s} sample + {checked} synthetic sequences, {sum(1 for b, _ in mismatches if b == backend)} mismatches', file=log)
+    return mismatches
+
+def version_problem(expected, digests=None): # why the stored expected tokens and TOKENIZER_VERSION disagree (None if they do not); 'digests': the new ones, or None if the tokens of some backend differ
+    if digests is not None and digests == expected['digests']:
+        return None
+    if TOKENIZER_VERSION == expected['tokenizer_version']:
+        return f'the tokens changed, but TOKENIZER_VERSION did not (still {TOKENIZER_VERSION}): bump it in score_to_tokens.py'
+    if digests is None:
+        return f"the tokens differ from those of version {expected['tokenizer_version']}; if the change is meant, run --save-expected"
+    return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that every tokenizer backend gives the tokens of the original MusicXML_to_tokens on the sample score and on synthetic piano scores.')
+    parser.add_argument('--expected', default=DEFAULT_EXPECTED, help='digests of the expected token sequences (JSON)')
+    parser.add_argument('--save-expected', action='store_true', help='store the output of MusicXML_to_tokens as the expected tokens (only when the tokens are meant to change; refused unless TOKENIZER_VERSION was bumped)')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes of the parallel backends (default: CPU count)')
+    args = parser.parse_args(argv)
+
+    expected = {'tokenizer_version': None, 'digests': {}}
+    if os.path.exists(args.expected):
+        with open(args.expected) as f:
+            expected = json.load(f)
+
+    if args.save_expected:
+        digests = expected_digests()
+        problem = version_problem(expected, digests)
+        if problem:
+            print(f'not saved: {problem}')
+            return 1
+        with open(args.expected, 'w') as f:
+            json.dump({'tokenizer_version': TOKENIZER_VERSION, 'digests': digests}, f, indent=1, sort_keys=True)
+        print(f'expected tokens of version {TOKENIZER_VERSION} saved to {args.expected}')
+        return 0
+
+    mismatches = check(expected['digests'], args.workers)
+    for backend, name in mismatches:
+        print(f'MISMATCH {backend} {name}')
+    print(f'{len(mismatches)} mismatches')
+    if mismatches:
+        print(version_problem(expected))
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import difflib
+import hashlib
+import os
+from collections import OrderedDict, namedtuple
+
+from lxml import etree
+
+from score_to_tokens import MeasureTokens, TOKENIZER_VERSION, iter_measure_tags, join_measure_tokens, label_hands, lxml_measure_to_elements, measure_to_staff_tokens, part_staves, piano_hands, staff_count
+
+# one changed region of a staff: measure numbers and tokens before / after the edit
+MeasureDiff = namedtuple('MeasureDiff', ['staff', 'op', 'old_measures', 'new_measures', 'old_tokens', 'new_tokens']) # op: 'replace', 'insert' or 'delete'
+IncrementalResult = namedtuple('IncrementalResult', ['tokens', 'measures', 'diff', 'reused', 'computed'])
+
+def measure_content(measure): # raw XML of the children of an lxml <measure> that the tokenizer reads (as lxml_measure_to_elements), so a memo hit needs no extraction
+    return b''.join(etree.tostring(child, with_tail=False) for child in measure.iterchildren('note', 'attributes', 'backup', 'forward'))
+
+def measure_fingerprint(content, staves, divisions, note_name): # measure content + incoming state
+    return hashlib.blake2b(repr((TOKENIZER_VERSION, note_name, staves, divisions)).encode('utf-8') + content, digest_size=16).digest()
+
+def diff_measures(old, new): # MeasureTokens lists -> MeasureDiff list, per staff
+    diff = []
+    for staff in dict.fromkeys([m.staff for m in old + new]):
+        old_staff = [m for m in old if m.staff == staff]
+        new_staff = [m for m in new if m.staff == staff]
+        matcher = difflib.SequenceMatcher(None, [tuple(m.tokens) for m in old_staff], [tuple(m.tokens) for m in new_staff], autojunk=False)
+        for op, i1, i2, j1, j2 in matcher.get_opcodes():
+            if op != 'equal':
+                diff.append(MeasureDiff(staff, op,
+                                        [m.number for m in old_staff[i1:i2]], [m.number for m in new_staff[j1:j2]],
+                                        [t for m in old_staff[i1:i2] for t in m.tokens], [t for m in new_staff[j1:j2] for t in m.tokens]))
+    return diff
+
+class IncrementalTokenizer: # re-tokenize edited scores, reusing the tokens of measures whose content and incoming state are unchanged; the score is still parsed in full, but unchanged measures are neither extracted nor tokenized
+    def __init__(self, note_name=True, max_measures=100000):
+        self.note_name = note_name
+        self.max_measures = max_measures
+        self.memo = OrderedDict() # fingerprint -> (staff tokens, outgoing divisions), least recently used first
+        self.previous = {} # document -> MeasureTokens of its last tokenization
+
+    def tokenize_measure(self, measure, staves, divisions): # lxml <measure> -> (staff tokens, outgoing divisions), memo hit
+        key = measure_fingerprint(measure_content(measure), staves, divisions, self.note_name)
+        if key in self.memo:
+            self.memo.move_to_end(key)
+            return self.memo[key], True
+
+        result = measure_to_staff_tokens(lxml_measure_to_elements(measure), staves, divisions, self.note_name)
+        self.memo[key] = result
+        if len(self.memo) > self.max_measures:
+            self.memo.popitem(last=False)
+        return result, False
+
+    def tokenize(self, source, document=None): # document: name to diff against (defaults to the path of 'source')
+        if document is None and isinstance(source, (str, os.PathLike)):
+            document = os.fspath(source)
+
+        measures, reused, computed, staff_counts, part_count = [], 0, 0, {}, 0
+        for part_count, part_index, measure in iter_measure_tags(source):
+            if part_index not in staff_counts: # first measure of a part
+                staff_counts[part_index] = staff_count(lxml_measure_to_elements(measure))
+                staves, labels = part_staves(part_count, part_index, staff_counts[part_index], piano_hands(part_count, staff_counts))
+                divisions = (0,) * len(staves)
+            (staff_tokens, divisions), hit = self.tokenize_measure(measure, staves, divisions)
+            reused, computed = reused + hit, computed + (not hit)
+            measures += [MeasureTokens(part_index, measure.get('number'), label, tokens) for label, tokens in zip(labels, staff_tokens)]
+        if piano_hands(part_count, staff_counts): # the first part was labelled before the second was seen
+            measures = label_hands(measures)
+
+        diff = diff_measures(self.previous.get(document, []), measures)
+        if document is not None:
+            self.previous[document] = measures
+        return IncrementalResult(join_measure_tokens(measures), measures, diff, reused, computed)
@@ -0,0 +1,8 @@
+def percentile(seconds, q): # q-quantile (0 <= q <= 1) of sorted 'seconds'
+    return seconds[min(len(seconds) - 1, int(q * len(seconds)))]
+
+def latency_summary(seconds, items='files'): # per-item latency statistics in milliseconds; shared by the batch tools of the tokenizer and the detokenizer
+    if not seconds:
+        return f'no {items}'
+    seconds = sorted(seconds)
+    return f'mean {sum(seconds) / len(seconds) * 1e3:.1f} ms, p50 {percentile(seconds, 0.5) * 1e3:.1f} ms, p95 {percentile(seconds, 0.95) * 1e3:.1f} ms, max {seconds[-1] * 1e3:.1f} ms'
@@ -0,0 +1,148 @@
+import argparse
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pretty_midi
+
+from packed_corpus import PackedCorpusWriter
+from vocabulary import Vocabulary
+
+MIDI_EXTENSIONS = ('.mid', '.midi')
+RESOLUTION = 12 # ticks per quarter note (16th notes and 8th-note triplets)
+MAX_BAR_QUARTERS = 16 # positions cover bars up to 16/4
+MAX_LENGTH_QUARTERS = 8 # longer notes are clipped
+DEFAULT_TIME_SIGNATURE = (4, 4) # before the first time signature change
+
+def build_input_vocabulary(resolution=RESOLUTION): # input (note-level) token list: bar, onset position in the bar, MIDI pitch, length in ticks
+    tokens = ['<pad>', '<unk>', 'bar']
+    tokens += [f'pos_{tick}' for tick in range(resolution * MAX_BAR_QUARTERS)]
+    tokens += [f'note_{pitch}' for pitch in range(128)]
+    tokens += [f'len_{tick}' for tick in range(1, resolution * MAX_LENGTH_QUARTERS + 1)]
+    return tokens
+
+class MidiTokenizer: # quantized MIDI -> input token IDs, on whole note arrays at once
+    def __init__(self, resolution=RESOLUTION):
+        self.resolution = resolution
+        self.vocabulary = Vocabulary(build_input_vocabulary(resolution))
+        ids = self.vocabulary.ids
+        self.bar_id, self.pos_base, self.note_base, self.len_base = ids['bar'], ids['pos_0'], ids['note_0'], ids['len_1'] - 1
+        self.max_position, self.max_length = resolution * MAX_BAR_QUARTERS, resolution * MAX_LENGTH_QUARTERS
+
+    def quarters(self, midi, times): # seconds -> quarter notes from the start, following the tempo changes
+        change_times, tempi = midi.get_tempo_changes()
+        if not len(change_times):
+            change_times, tempi = np.zeros(1), np.full(1, 120.0)
+        change_quarters = np.concatenate([[0.0], np.cumsum(np.diff(change_times) * tempi[:-1] / 60)])
+        segment = np.maximum(np.searchsorted(change_times, times, side='right') - 1, 0)
+        return change_quarters[segment] + (times - change_times[segment]) * tempi[segment] / 60
+
+    def bar_starts(self, midi, end): # tick of every bar start up to tick 'end'
+        changes = [(0.0, *DEFAULT_TIME_SIGNATURE)] if not midi.time_signature_changes or midi.time_signature_changes[0].time > 0 else []
+        changes += [(ts.time, ts.numerator, ts.denominator) for ts in midi.time_signature_changes]
+        change_ticks = np.rint(self.quarters(midi, np.array([c[0] for c in changes])) * self.resolution).astype(np.int64)
+        starts = []
+        for i, (_, numerator, denominator) in enumerate(changes):
+            segment_end = change_ticks[i + 1] if i + 1 < len(changes) else max(end, change_ticks[i] + 1)
+            bar_length = max(int(round(self.resolution * 4 * numerator / denominator)), 1)
+            starts.append(np.arange(change_ticks[i], segment_end, bar_length))
+        return np.concatenate(starts)
+
+    def quantize(self, midi): # -> onset ticks, length ticks, pitches, bar indexes and positions in the bar, sorted by onset, pitch and length
+        notes = [np.array([(note.start, note.end, note.pitch) for note in instrument.notes], dtype=np.float64).reshape(-1, 3)
+                 for instrument in midi.instruments if not instrument.is_drum]
+        notes = np.concatenate(notes) if notes else np.zeros((0, 3))
+        ticks = np.rint(self.quarters(midi, notes[:, :2]) * self.resolution).astype(np.int64)
+        onsets, pitches = ticks[:, 0], notes[:, 2].astype(np.int64)
+        lengths = np.clip(ticks[:, 1] - onsets, 1, self.max_length)
+        order = np.lexsort((lengths, pitches, onsets))
+        onsets, lengths, pitches = onsets[order], lengths[order], pitches[order]
+
+        bar_starts = self.bar_starts(midi, onsets[-1] + 1 if len(onsets) else 0)
+        bars = np.maximum(np.searchsorted(bar_starts, onsets, side='right') - 1, 0)
+        positions = onsets - bar_starts[bars]
+        if len(positions) and positions.max() >= self.max_position:
+            raise ValueError(f'bars longer than {MAX_BAR_QUARTERS} quarter notes')
+        return onsets, lengths, pitches, bars, positions
+
+    def notes_to_ids(self, bars, positions, pitches, lengths, bar_count=0): # sorted note arrays -> input token IDs; at least 'bar_count' bars
+        dtype = np.dtype(self.vocabulary.typecode)
+        if not len(bars):
+            return np.full(bar_count, self.bar_id, dtype=dtype)
+
+        # per note: 'bar' for each bar started before it (empty ones included), 'pos_' if its onset is new, 'note_', 'len_'
+        new_bars = bars - np.concatenate([[-1], bars[:-1]])
+        new_position = (new_bars > 0) | (positions != np.concatenate([[-1], positions[:-1]]))
+        counts = new_bars + new_position + 2
+        ends = np.cumsum(counts)
+        starts = ends - counts
+        trailing_bars = max(bar_count - int(bars[-1]) - 1, 0)
+
+        ids = np.full(ends[-1] + trailing_bars, self.bar_id, dtype=dtype)
+        ids[(starts + new_bars)[new_position]] = self.pos_base + positions[new_position]
+        ids[ends - 2] = self.note_base + pitches
+        ids[ends - 1] = self.len_base + np.clip(lengths, 1, self.max_length)
+        return ids
+
+    def to_ids(self, source): # PrettyMIDI object, path or file-like object -> numpy array of input token IDs
+        midi = source if isinstance(source, pretty_midi.PrettyMIDI) else pretty_midi.PrettyMIDI(source)
+        _, lengths, pitches, bars, positions = self.quantize(midi)
+        return self.notes_to_ids(bars, positions, pitches, lengths)
+
+    def to_tokens(self, source):
+        return self.vocabulary.decode(self.to_ids(source).tolist())
+
+def find_midi(inputs): # files and directories (searched recursively) -> sorted MIDI paths
+    paths = []
+    for input_ in inputs:
+        if os.path.isdir(input_):
+            for root, _, files in os.walk(input_):
+                paths += [os.path.join(root, f) for f in files if f.lower().endswith(MIDI_EXTENSIONS)]
+        else:
+            paths.append(input_)
+    return sorted(set(os.path.normpath(p) for p in paths))
+
+tokenizer = None
+
+def init_worker(resolution=RESOLUTION):
+    global tokenizer
+    tokenizer = MidiTokenizer(resolution)
+
+def midi_ids(path): # worker: path -> (path, ids, error)
+    try:
+        return path, tokenizer.to_ids(path), None
+    except Exception as e:
+        return path, None, f'{type(e).__name__}: {e}'
+
+def pack_midi(inputs, out_path, workers=None, resolution=RESOLUTION, log=sys.stderr): # MIDI files / directories -> packed corpus of input token IDs (one measure per 'bar')
+    start, failed = time.perf_counter(), 0
+    paths = find_midi(inputs)
+    with PackedCorpusWriter(out_path, MidiTokenizer(resolution).vocabulary, staves=()) as writer:
+        if paths:
+            with Pool(workers, initializer=init_worker, initargs=(resolution,)) as pool:
+                for path, ids, error in pool.imap(midi_ids, paths, chunksize=8):
+                    if error is None:
+                        writer.add_ids(path, ids)
+                    else:
+                        failed += 1
+                        print(f'{path}: {error}', file=log)
+        count, tokens = len(writer.names), writer.sequences[-1]
+
+    print(f'{count} MIDI files, {tokens} tokens packed in {time.perf_counter() - start:.1f} s ({failed} failed)', file=log)
+    return count, failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert MIDI files into quantized input token IDs, packed into a memory-mapped corpus.')
+    parser.add_argument('inputs', nargs='+', help='MIDI files or directories')
+    parser.add_argument('-o', '--out', required=True, help='packed corpus directory')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--resolution', type=int, default=RESOLUTION, help=f'ticks per quarter note (default: {RESOLUTION})')
+    args = parser.parse_args(argv)
+
+    _, failed = pack_midi(args.inputs, args.out, args.workers, args.resolution)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from batch_tokenize import find_scores, tokenize_score
+from packed_corpus import META_NAME, PackedCorpus
+from vocabulary import MusicXML_to_ids, Vocabulary, default_vocabulary
+
+SHINGLE_SIZE = 8 # tokens per shingle
+NUM_PERM = 128 # MinHash signature length
+THRESHOLD = 0.8 # estimated Jaccard similarity of near-duplicates
+IGNORED_PREFIXES = ('stem_', 'beam_') # engraving choices that differ between editions of the same piece
+SHINGLE_BASE = np.uint64(0x100000001b3) # polynomial hash of the token IDs of a shingle (mod 2^64)
+MIX = np.uint64(0x9e3779b97f4a7c15)
+BLOCK = 4096 # shingles hashed at once, to bound memory on long scores
+
+# files of an index directory
+SIGNATURES_NAME = 'signatures.npy' # (n, num_perm) uint32
+NAMES_NAME = 'names.txt'
+VOCABULARY_NAME = 'vocabulary.txt'
+INDEX_META_NAME = 'index.json' # parameters
+
+def lsh_bands(num_perm, threshold): # (bands, rows) of the LSH whose S-curve (1 / bands) ^ (1 / rows) is closest to the threshold
+    splits = [(bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0]
+    return min(splits, key=lambda split: abs((1 / split[0]) ** (1 / split[1]) - threshold))
+
+class MinHasher: # token IDs -> MinHash signature of their (set of) shingles
+    def __init__(self, vocabulary=None, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1, ignored_prefixes=IGNORED_PREFIXES):
+        self.vocabulary = vocabulary if vocabulary is not None else default_vocabulary()
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        # multiply-shift hashing: h(x) = (a * x + b) mod 2^64 >> 32, with odd a
+        self.a = (rng.integers(0, 1 << 63, num_perm, dtype=np.uint64) << np.uint64(1)) | np.uint64(1)
+        self.b = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+        self.powers = np.cumprod(np.full(shingle_size, SHINGLE_BASE, dtype=np.uint64))
+        self.kept = np.array([not token.startswith(ignored_prefixes) for token in self.vocabulary.tokens], dtype=bool)
+
+    def shingles(self, ids): # distinct 32-bit shingle hashes
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = ids[self.kept[ids]].astype(np.uint64)
+        if not len(ids):
+            return ids
+        size = min(self.shingle_size, len(ids)) # short sequences are one shingle
+        shingles = np.lib.stride_tricks.sliding_window_view(ids, size) @ self.powers[:size]
+        return np.unique((shingles * MIX) >> np.uint64(32))
+
+    def signature(self, ids): # uint32 array of num_perm minima (None for sequences without shingles)
+        shingles = self.shingles(ids)
+        if not len(shingles):
+            return None
+        signature = np.full(len(self.a), np.iinfo(np.uint64).max, dtype=np.uint64)
+        for start in range(0, len(shingles), BLOCK):
+            block = shingles[None, start:start + BLOCK]
+            np.minimum(signature, ((self.a[:, None] * block + self.b[:, None]) >> np.uint64(32)).min(axis=1), out=signature)
+        return signature.astype(np.uint32)
+
+class NearDuplicateIndex: # MinHash signatures of pieces, bucketed by LSH bands; only the signatures are kept
+    def __init__(self, vocabulary=None, threshold=THRESHOLD, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1):
+        self.hasher = MinHasher(vocabulary, num_perm, shingle_size, seed)
+        self.threshold, self.num_perm, self.shingle_size, self.seed = threshold, num_perm, shingle_size, seed
+        self.bands, self.rows = lsh_bands(num_perm, threshold)
+        self.names, self.signatures = [], []
+        self.buckets = [{} for _ in range(self.bands)] # band -> {band bytes: [piece index, ...]}
+
+    def __len__(self):
+        return len(self.names)
+
+    def band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def similarity(self, i, signature): # estimated Jaccard similarity
+        return float(np.mean(self.signatures[i] == signature))
+
+    def query(self, signature): # [(name, similarity), ...] of indexed pieces at or above the threshold, most similar first
+        if signature is None:
+            return []
+        candidates = set()
+        for buckets, key in zip(self.buckets, self.band_keys(signature)):
+            candidates.update(buckets.get(key, ()))
+        matches = [(self.names[i], self.similarity(i, signature)) for i in candidates]
+        return sorted([m for m in matches if m[1] >= self.threshold], key=lambda m: -m[1])
+
+    def insert_signature(self, name, signature): # -> near-duplicates among the pieces indexed before
+        matches = self.query(signature)
+        if signature is not None:
+            for buckets, key in zip(self.buckets, self.band_keys(signature)):
+                buckets.setdefault(key, []).append(len(self.names))
+            self.names.append(name)
+            self.signatures.append(signature)
+        return matches
+
+    def insert(self, name, ids): # token IDs (of the index vocabulary) of a new piece -> its near-duplicates
+        return self.insert_signature(name, self.hasher.signature(ids))
+
+    def clusters(self): # groups (lists of names) of near-duplicate pieces, largest first
+        parent = list(range(len(self.names)))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        checked = set()
+        for buckets in self.buckets:
+            for members in buckets.values():
+                for x, i in enumerate(members):
+                    for j in members[x + 1:]:
+                        if (i, j) not in checked and find(i) != find(j):
+                            checked.add((i, j))
+                            if self.similarity(i, self.signatures[j]) >= self.threshold:
+                                parent[find(j)] = find(i)
+
+        groups = {}
+        for i in range(len(self.names)):
+            groups.setdefault(find(i), []).append(self.names[i])
+        return sorted([group for group in groups.values() if len(group) > 1], key=len, reverse=True)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, SIGNATURES_NAME), np.array(self.signatures, dtype=np.uint32).reshape(-1, self.num_perm))
+        with open(os.path.join(path, NAMES_NAME), 'w', encoding='utf-8') as f:
+            f.write(''.join(name + '\n' for name in self.names))
+        self.hasher.vocabulary.save(os.path.join(path, VOCABULARY_NAME))
+        with open(os.path.join(path, INDEX_META_NAME), 'w') as f: # written last
+            json.dump({'threshold': self.threshold, 'num_perm': self.num_perm, 'shingle_size': self.shingle_size, 'seed': self.seed, 'pieces': len(self.names)}, f, indent=1)
+
+    @classmethod
+    def load(cls, path, threshold=None):
+        with open(os.path.join(path, INDEX_META_NAME)) as f:
+            meta = json.load(f)
+        index = cls(Vocabulary.load(os.path.join(path, VOCABULARY_NAME)), threshold or meta['threshold'], meta['num_perm'], meta['shingle_size'], meta['seed'])
+        with open(os.path.join(path, NAMES_NAME), encoding='utf-8') as f:
+            names = f.read().splitlines()
+        for name, signature in zip(names, np.load(os.path.join(path, SIGNATURES_NAME))):
+            index.insert_signature(name, signature)
+        return index
+
+hasher = None
+
+def init_worker(num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1):
+    global hasher
+    hasher = MinHasher(None, num_perm, shingle_size, seed)
+
+def score_signature(path): # worker: path -> (path, signature, error)
+    try:
+        return path, hasher.signature(tokenize_score(path, True, MusicXML_to_ids)), None
+    except Exception as e:
+        return path, None, f'{type(e).__name__}: {e}'
+
+def iter_signatures(index, inputs, workers=None, log=sys.stderr): # yield (name, signature) of scores and packed corpora, streaming (one piece per worker in memory)
+    corpora = [i for i in inputs if os.path.exists(os.path.join(i, META_NAME))]
+    for path in corpora:
+        corpus = PackedCorpus(path)
+        to_index = np.array([index.hasher.vocabulary.id(token) for token in corpus.vocabulary.tokens], dtype=np.int64) # corpus IDs -> index IDs
+        for name, ids in zip(corpus.names, corpus):
+            yield name, index.hasher.signature(to_index[ids])
+
+    paths = find_scores([i for i in inputs if i not in corpora])
+    if paths:
+        with Pool(workers, initializer=init_worker, initargs=(index.num_perm, index.shingle_size, index.seed)) as pool:
+            for path, signature, error in pool.imap(score_signature, paths, chunksize=4):
+                if error is None:
+                    yield path, signature
+                else:
+                    print(f'{path}: {error}', file=log)
+
+def add_to_index(index, inputs, workers=None, log=sys.stderr): # insert pieces, printing the near-duplicates found for each; -> number of pieces with near-duplicates
+    start, count, duplicated = time.perf_counter(), 0, 0
+    for name, signature in iter_signatures(index, inputs, workers, log):
+        matches = index.insert_signature(name, signature)
+        count += 1
+        if matches:
+            duplicated += 1
+            print(json.dumps({'name': name, 'duplicates': [{'name': n, 'similarity': round(s, 3)} for n, s in matches]}, ensure_ascii=False))
+    print(f'{count} pieces indexed in {time.perf_counter() - start:.1f} s, {duplicated} with near-duplicates ({len(index)} in the index)', file=log)
+    return duplicated
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='MinHash / LSH index of near-duplicate scores over token shingles.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='create an index from scores and packed corpora')
+    build.add_argument('inputs', nargs='+', help='score files, directories, zip archives of scores or packed corpus directories')
+    build.add_argument('-o', '--out', required=True, help='index directory')
+    build.add_argument('--threshold', type=float, default=THRESHOLD, help=f'estimated Jaccard similarity of near-duplicates (default: {THRESHOLD})')
+    build.add_argument('--num-perm', type=int, default=NUM_PERM, help=f'MinHash signature length (default: {NUM_PERM})')
+    build.add_argument('--shingle-size', type=int, default=SHINGLE_SIZE, help=f'tokens per shingle (default: {SHINGLE_SIZE})')
+    add = commands.add_parser('add', help='insert new pieces into an index, reporting their near-duplicates')
+    add.add_argument('index')
+    add.add_argument('inputs', nargs='+')
+    clusters = commands.add_parser('clusters', help='print the clusters of near-duplicate pieces (one JSON list per line)')
+    clusters.add_argument('index')
+    clusters.add_argument('--threshold', type=float, default=None, help='override the threshold of the index')
+    for command in (build, add):
+        command.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'clusters':
+        groups = NearDuplicateIndex.load(args.index, args.threshold).clusters()
+        for group in groups:
+            print(json.dumps(group, ensure_ascii=False))
+        print(f'{len(groups)} clusters, {sum(map(len, groups))} pieces', file=sys.stderr)
+        return 0
+
+    if args.command == 'build':
+        index, path = NearDuplicateIndex(threshold=args.threshold, num_perm=args.num_perm, shingle_size=args.shingle_size), args.out
+    else:
+        index, path = NearDuplicateIndex.load(args.index), args.index
+    add_to_index(index, args.inputs, args.workers)
+    index.save(path)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
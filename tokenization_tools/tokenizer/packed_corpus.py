@@ -0,0 +1,211 @@
+import argparse
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from batch_tokenize import DONE, MANIFEST_NAME, find_scores, read_manifest, tokenize_score
+from score_to_tokens import TOKENIZER_VERSION
+from vocabulary import MusicXML_to_ids, Vocabulary, default_vocabulary
+
+FORMAT_VERSION = 1
+STAVES = ('R', 'L') # section tokens of score token sequences
+
+# files of a packed corpus directory
+TOKENS_NAME = 'tokens.bin' # all token IDs, sequence after sequence
+SEQUENCES_NAME = 'sequences.npy' # (n + 1,) token offset of each sequence, and the end
+STAVES_NAME = 'staves.npy' # (n, s, 2) [start, end) token range of each staff of each sequence (from its 'R' / 'L' token; the whole sequence if there are no staves)
+MEASURES_NAME = 'measures.npy' # (m, 2) [start, end) token range of each measure (from its 'bar' token)
+STAFF_MEASURES_NAME = 'staff_measures.npy' # (n, s, 2) [first, end) measure index of each staff of each sequence
+NAMES_NAME = 'names.txt'
+VOCABULARY_NAME = 'vocabulary.txt'
+META_NAME = 'meta.json' # written last; a directory without it is incomplete
+
+class PackedCorpusWriter: # append token ID sequences to a packed corpus directory; staves=() for sequences without staff sections (e.g. MIDI input tokens)
+    def __init__(self, path, vocabulary=None, staves=STAVES):
+        self.path = path
+        self.vocabulary = vocabulary if vocabulary is not None else default_vocabulary()
+        self.dtype = np.dtype(self.vocabulary.typecode)
+        self.staff_names = tuple(staves)
+        self.staff_ids = [self.vocabulary.ids[staff] for staff in self.staff_names]
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, META_NAME)):
+            os.remove(os.path.join(path, META_NAME))
+        self.tokens = open(os.path.join(path, TOKENS_NAME), 'wb')
+        self.names, self.sequences, self.staves, self.measures, self.staff_measures = [], [0], [], [], []
+        self.measure_count = 0
+
+    def add(self, name, source, note_name=True): # tokenize a score (path, bytes or file-like object) into the corpus
+        self.add_ids(name, MusicXML_to_ids(source, note_name, self.vocabulary))
+
+    def add_tokens(self, name, tokens): # token strings, e.g. a line of generated_tokens.txt or a batch_tokenize shard
+        self.add_ids(name, self.vocabulary.encode(tokens))
+
+    def add_ids(self, name, ids): # one sequence: e.g. 'R' + R measures + 'L' + L measures
+        ids = np.asarray(ids, dtype=self.dtype)
+        starts = [0]
+        if self.staff_ids:
+            starts = [int(np.argmax(ids == staff_id)) for staff_id in self.staff_ids] # first occurrences
+            if not len(ids) or any(ids[s] != staff_id for s, staff_id in zip(starts, self.staff_ids)) or starts != sorted(starts) or starts[0] != 0:
+                raise ValueError(f"{name}: not a {'/'.join(self.staff_names)} token sequence")
+        start, end = self.sequences[-1], len(ids)
+        sections = np.array(starts + [end])
+
+        # a measure runs from its 'bar' token to the next one, or to the end of its staff
+        bars = np.flatnonzero(ids == self.vocabulary.bar_id)
+        staff_of_bar = np.searchsorted(sections, bars, side='right') - 1
+        ends = np.append(bars[1:], end)
+        last = np.append(staff_of_bar[1:] != staff_of_bar[:-1], True) if len(bars) else np.zeros(0, dtype=bool)
+        ends[last] = sections[staff_of_bar[last] + 1]
+        first_measures = self.measure_count + np.searchsorted(staff_of_bar, np.arange(len(starts) + 1))
+
+        ids.tofile(self.tokens)
+        self.names.append(name)
+        self.sequences.append(start + end)
+        self.staves.append(np.stack([sections[:-1], sections[1:]], axis=1) + start)
+        self.measures.append(np.stack([bars, ends], axis=1) + start)
+        self.staff_measures.append(np.stack([first_measures[:-1], first_measures[1:]], axis=1))
+        self.measure_count += len(bars)
+
+    def close(self):
+        self.tokens.close()
+        np.save(os.path.join(self.path, SEQUENCES_NAME), np.array(self.sequences, dtype=np.int64))
+        sections = max(len(self.staff_names), 1)
+        np.save(os.path.join(self.path, STAVES_NAME), np.array(self.staves, dtype=np.int64).reshape(-1, sections, 2))
+        np.save(os.path.join(self.path, MEASURES_NAME), np.concatenate(self.measures).astype(np.int64) if self.measures else np.zeros((0, 2), dtype=np.int64))
+        np.save(os.path.join(self.path, STAFF_MEASURES_NAME), np.array(self.staff_measures, dtype=np.int64).reshape(-1, sections, 2))
+        with open(os.path.join(self.path, NAMES_NAME), 'w', encoding='utf-8') as f:
+            f.write(''.join(name + '\n' for name in self.names))
+        self.vocabulary.save(os.path.join(self.path, VOCABULARY_NAME))
+        meta = {'format_version': FORMAT_VERSION, 'tokenizer_version': TOKENIZER_VERSION, 'dtype': self.dtype.str, 'staves': list(self.staff_names),
+                'sequences': len(self.names), 'tokens': self.sequences[-1], 'measures': self.measure_count}
+        with open(os.path.join(self.path, META_NAME), 'w') as f:
+            json.dump(meta, f, indent=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else: # leave the directory without meta.json (incomplete)
+            self.tokens.close()
+
+class PackedCorpus: # read-only, memory-mapped view of a packed corpus; every accessor returns a view into the token file
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_NAME)) as f:
+            self.meta = json.load(f)
+        if self.meta['format_version'] != FORMAT_VERSION:
+            raise ValueError(f"unsupported packed corpus format {self.meta['format_version']}")
+        self.vocabulary = Vocabulary.load(os.path.join(path, VOCABULARY_NAME))
+        self.staff_names = tuple(self.meta.get('staves', STAVES))
+        dtype = np.dtype(self.meta['dtype'])
+        self.tokens = np.memmap(os.path.join(path, TOKENS_NAME), dtype=dtype, mode='r') if self.meta['tokens'] else np.zeros(0, dtype=dtype)
+        self.sequences, self.staves, self.measures, self.staff_measures = (np.load(os.path.join(path, name), mmap_mode='r')
+                                                                          for name in (SEQUENCES_NAME, STAVES_NAME, MEASURES_NAME, STAFF_MEASURES_NAME))
+        with open(os.path.join(path, NAMES_NAME), encoding='utf-8') as f:
+            self.names = f.read().splitlines()
+        self.name_index = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i): # token IDs of sequence i
+        return self.tokens[self.sequences[i]:self.sequences[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def index(self, name):
+        if self.name_index is None:
+            self.name_index = {name: i for i, name in enumerate(self.names)}
+        return self.name_index[name]
+
+    def staff_index(self, staff): # None: the only section of corpora without staves
+        return 0 if staff is None and not self.staff_names else self.staff_names.index(staff)
+
+    def staff(self, i, staff): # token IDs of the 'R' or 'L' staff of sequence i, starting with the staff token
+        start, end = self.staves[i, self.staff_index(staff)]
+        return self.tokens[start:end]
+
+    def measure_count(self, i, staff='R'):
+        first, end = self.staff_measures[i, self.staff_index(staff)]
+        return int(end - first)
+
+    def measure(self, i, staff, j): # token IDs of the j-th measure (from 0) of a staff of sequence i, starting with 'bar'
+        first, end = self.staff_measures[i, self.staff_index(staff)]
+        if not 0 <= j < end - first:
+            raise IndexError(f'measure {j} out of range ({end - first} measures)')
+        start, end = self.measures[first + j]
+        return self.tokens[start:end]
+
+    def decode(self, ids):
+        return self.vocabulary.decode(ids.tolist())
+
+def score_ids(job): # worker: (path, note_name) -> (path, ids, error)
+    path, note_name = job
+    try:
+        return path, tokenize_score(path, note_name, MusicXML_to_ids), None
+    except Exception as e:
+        return path, None, f'{type(e).__name__}: {e}'
+
+def shard_sequences(out_dir): # (path, tokens) of the pieces done by batch_tokenize, shard by shard
+    shards = {}
+    for entry in read_manifest(out_dir).values():
+        if entry['status'] == DONE:
+            shards.setdefault(entry['shard'], set()).add(entry['line'])
+    for shard in sorted(shards):
+        with open(os.path.join(out_dir, shard), encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                if i in shards[shard]: # lines superseded by a later run are skipped
+                    path, tokens = line.rstrip('\n').split('\t')
+                    yield path, tokens.split(' ')
+
+def pack_corpus(inputs, out_path, workers=None, note_name=True, log=sys.stderr): # scores / batch_tokenize output directories -> packed corpus
+    start, failed, skipped = time.perf_counter(), 0, 0
+    with PackedCorpusWriter(out_path) as writer:
+        shard_dirs = [i for i in inputs if os.path.exists(os.path.join(i, MANIFEST_NAME))]
+        for shard_dir in shard_dirs:
+            for path, tokens in shard_sequences(shard_dir):
+                try:
+                    writer.add_tokens(path, tokens)
+                except ValueError as e: # not a piano (R / L) sequence, e.g. an ensemble score with part_N sections
+                    skipped += 1
+                    print(e, file=log)
+
+        paths = find_scores([i for i in inputs if i not in shard_dirs])
+        if paths:
+            with Pool(workers) as pool:
+                for path, ids, error in pool.imap(score_ids, [(p, note_name) for p in paths], chunksize=4):
+                    if error is not None:
+                        failed += 1
+                        print(f'{path}: {error}', file=log)
+                        continue
+                    try:
+                        writer.add_ids(path, ids)
+                    except ValueError as e:
+                        skipped += 1
+                        print(e, file=log)
+        count, tokens = len(writer.names), writer.sequences[-1]
+
+    print(f'{count} sequences, {tokens} tokens packed in {time.perf_counter() - start:.1f} s ({failed} failed, {skipped} skipped)', file=log)
+    return count, failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack token sequences into a memory-mapped corpus (token IDs + sequence / staff / measure offsets).')
+    parser.add_argument('inputs', nargs='+', help='score files, directories or zip archives of scores, or output directories of batch_tokenize.py')
+    parser.add_argument('-o', '--out', required=True, help='packed corpus directory')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--midi-number', action='store_true', help='emit MIDI note numbers instead of note names')
+    args = parser.parse_args(argv)
+
+    _, failed = pack_corpus(args.inputs, args.out, args.workers, not args.midi_number)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
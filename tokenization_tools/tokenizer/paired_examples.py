@@ -0,0 +1,190 @@
+import argparse
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from batch_tokenize import find_scores, tokenize_score
+from midi_to_tokens import RESOLUTION, MidiTokenizer
+from packed_corpus import PackedCorpus, PackedCorpusWriter
+from score_to_tokens import AttributesElement, NoteElement, index_measure, iter_MusicXML_measures, iter_score_tokens, pitch_to_token
+from vocabulary import default_vocabulary
+
+INPUT_DIR, SCORE_DIR = 'input', 'score' # packed corpora of a paired corpus directory, with the same sequences in the same order
+
+class NoteCollector: # note-level input events of one part, measure by measure; tied notes are merged as in a rendered MIDI file
+    def __init__(self, resolution=RESOLUTION):
+        self.resolution = resolution
+        self.divisions = None
+        self.measure = -1
+        self.measure_start = 0 # ticks from the start of the part
+        self.open_notes = {} # (staff, voice, MIDI pitch) -> index of the last note, for ties
+        self.bars, self.positions, self.pitches, self.lengths, self.ends = [], [], [], [], []
+
+    def add_measure(self, elements):
+        self.measure += 1
+        measure_end = 0
+        for element, onset, offset in zip(elements, *index_measure(elements)[:2]):
+            type_ = type(element)
+            if type_ is AttributesElement:
+                self.divisions = element.divisions or self.divisions
+                continue
+            if offset is not None:
+                measure_end = max(measure_end, self.ticks(offset))
+            if type_ is not NoteElement or element.rest or onset is None: # rests, gracenotes
+                continue
+
+            position, end = max(self.ticks(onset), 0), max(self.ticks(offset), 1) # <backup>s past the measure start are clamped to it
+            for pitch in element.pitches:
+                midi = int(pitch_to_token(tuple(pitch), False)[len('note_'):])
+                key = (element.staff, element.voice, midi)
+                last = self.open_notes.get(key)
+                if element.tie == 'stop' and last is not None and self.ends[last] == self.measure_start + position: # continuation of a tied note
+                    self.lengths[last] += end - position
+                    self.ends[last] += end - position
+                    continue
+                self.open_notes[key] = len(self.bars)
+                self.bars.append(self.measure)
+                self.positions.append(position)
+                self.pitches.append(midi)
+                self.lengths.append(end - position)
+                self.ends.append(self.measure_start + end)
+        self.measure_start += measure_end
+
+    def ticks(self, duration): # <duration> units -> ticks
+        return int(round(duration * self.resolution / (self.divisions or 1)))
+
+    def arrays(self):
+        return tuple(np.array(values, dtype=np.int64) for values in (self.bars, self.positions, self.pitches, self.lengths))
+
+def collecting(measures, collectors, resolution): # pass Measures through, feeding their elements to a new NoteCollector per part on the way
+    part = None
+    for measure in measures:
+        if measure.part != part:
+            part = measure.part
+            collectors.append(NoteCollector(resolution))
+        collectors[-1].add_measure(measure.elements)
+        yield measure
+
+def paired_ids(source, note_name=True, vocabulary=None, tokenizer=None): # one pass over a score -> (input token IDs, score token IDs), with one 'bar' per measure on both sides
+    vocabulary = vocabulary if vocabulary is not None else default_vocabulary()
+    tokenizer = tokenizer if tokenizer is not None else MidiTokenizer()
+    staves, collectors = {}, []
+    for measure in iter_score_tokens(collecting(iter_MusicXML_measures(source), collectors, tokenizer.resolution), note_name, vocabulary):
+        if measure.staff not in staves:
+            staves[measure.staff] = vocabulary.new_buffer([vocabulary.id(measure.staff)])
+        staves[measure.staff].extend(measure.tokens)
+    score_ids = vocabulary.new_buffer()
+    for staff_ids in staves.values():
+        score_ids.extend(staff_ids)
+
+    # the notes of all parts, measure by measure
+    bars, positions, pitches, lengths = (np.concatenate(columns) if columns else np.zeros(0, dtype=np.int64) for columns in zip(*(c.arrays() for c in collectors)))
+    order = np.lexsort((lengths, pitches, positions, bars))
+    if len(positions) and positions.max() >= tokenizer.max_position:
+        raise ValueError('measures longer than the input positions')
+    bar_count = max((c.measure + 1 for c in collectors), default=0)
+    return tokenizer.notes_to_ids(bars[order], positions[order], pitches[order], lengths[order], bar_count), np.frombuffer(score_ids, dtype=score_ids.typecode)
+
+class PairedCorpusWriter: # input and score packed corpora side by side; measure j of a sequence is measure j on both sides
+    def __init__(self, path, vocabulary=None, resolution=RESOLUTION):
+        self.tokenizer = MidiTokenizer(resolution)
+        self.vocabulary = vocabulary if vocabulary is not None else default_vocabulary()
+        self.input = PackedCorpusWriter(os.path.join(path, INPUT_DIR), self.tokenizer.vocabulary, staves=())
+        self.score = PackedCorpusWriter(os.path.join(path, SCORE_DIR), self.vocabulary)
+
+    def add(self, name, source, note_name=True):
+        self.add_ids(name, *paired_ids(source, note_name, self.vocabulary, self.tokenizer))
+
+    def add_ids(self, name, input_ids, score_ids):
+        self.score.add_ids(name, score_ids) # first, as it rejects sequences that are not R/L
+        self.input.add_ids(name, input_ids)
+
+    def close(self):
+        self.input.close()
+        self.score.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.input.__exit__(exc_type, *exc)
+        self.score.__exit__(exc_type, *exc)
+
+class PairedCorpus: # read-only view of a paired corpus directory
+    def __init__(self, path):
+        self.input = PackedCorpus(os.path.join(path, INPUT_DIR))
+        self.score = PackedCorpus(os.path.join(path, SCORE_DIR))
+        self.names = self.score.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i): # (input IDs, score IDs) of sequence i
+        return self.input[i], self.score[i]
+
+    def measure_count(self, i):
+        return self.input.measure_count(i, None)
+
+    def window(self, i, start, end): # (input IDs, score IDs) of measures [start, end) of sequence i; each score staff starts with its section token
+        input_ids = self.measures(self.input, i, None, start, end)
+        score_ids = [np.concatenate([[self.score.vocabulary.ids[staff]], self.measures(self.score, i, staff, start, end)]).astype(self.score.tokens.dtype)
+                     for staff in self.score.staff_names]
+        return input_ids, np.concatenate(score_ids)
+
+    @staticmethod
+    def measures(corpus, i, staff, start, end): # token IDs of measures [start, end) of a staff (clipped to its measure count)
+        first, last = corpus.staff_measures[i, corpus.staff_index(staff)]
+        start, end = first + min(start, last - first), first + min(end, last - first)
+        if start >= end:
+            return corpus.tokens[:0]
+        return corpus.tokens[corpus.measures[start, 0]:corpus.measures[end - 1, 1]]
+
+tokenizer = None
+
+def init_worker(resolution=RESOLUTION):
+    global tokenizer
+    tokenizer = MidiTokenizer(resolution)
+
+def score_pair(job): # worker: (path, note_name) -> (path, (input IDs, score IDs), error)
+    path, note_name = job
+    try:
+        return path, tokenize_score(path, note_name, lambda source, note_name: paired_ids(source, note_name, tokenizer=tokenizer)), None
+    except Exception as e:
+        return path, None, f'{type(e).__name__}: {e}'
+
+def pack_pairs(inputs, out_path, workers=None, note_name=True, resolution=RESOLUTION, log=sys.stderr): # scores -> paired corpus
+    start, failed = time.perf_counter(), 0
+    paths = find_scores(inputs)
+    with PairedCorpusWriter(out_path, resolution=resolution) as writer:
+        if paths:
+            with Pool(workers, initializer=init_worker, initargs=(resolution,)) as pool:
+                for path, ids, error in pool.imap(score_pair, [(p, note_name) for p in paths], chunksize=4):
+                    try:
+                        if error is not None:
+                            raise ValueError(error)
+                        writer.add_ids(path, *ids)
+                    except ValueError as e: # failed or not a piano score
+                        failed += 1
+                        print(f'{path}: {e}', file=log)
+        count = len(writer.score.names)
+
+    print(f'{count} pairs packed in {time.perf_counter() - start:.1f} s ({failed} failed)', file=log)
+    return count, failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build measure-aligned (input tokens, score tokens) training pairs from scores in one pass, packed into memory-mapped corpora.')
+    parser.add_argument('inputs', nargs='+', help='score files, directories or zip archives of scores')
+    parser.add_argument('-o', '--out', required=True, help='paired corpus directory')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--midi-number', action='store_true', help='emit MIDI note numbers instead of note names in score tokens')
+    parser.add_argument('--resolution', type=int, default=RESOLUTION, help=f'input ticks per quarter note (default: {RESOLUTION})')
+    args = parser.parse_args(argv)
+
+    _, failed = pack_pairs(args.inputs, args.out, args.workers, not args.midi_number, args.resolution)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+import contextlib
+import itertools
+import os
+from multiprocessing import Pool
+
+from lxml import etree
+
+from score_to_tokens import Measure, MeasureTokens, iter_measure_tags, iter_part_tokens, iter_staff_tokens, join_measure_tokens, label_hands, lxml_measure_to_elements, measure_to_staff_tokens, open_MusicXML, part_staves, piano_hands, staff_count, stream_MusicXML_to_tokens
+from token_cache import read_score_bytes
+
+def score_part_count(data): # number of <score-part>s, reading only up to the end of <part-list>
+    with open_MusicXML(data) as f:
+        for _, part_list in etree.iterparse(f, tag='part-list'):
+            return len(part_list.findall('score-part'))
+    return 0
+
+def part_to_tokens(job): # worker: (score bytes, part_count, part_index, note_name) -> MeasureTokens of that part, streaming through the score up to the next part
+    data, part_count, part_index, note_name = job
+    last = part_index == part_count - 1 # the last worker also takes <part>s missing from the part-list
+    staff_counts = {} # part index -> staff count, of the parts read so far (for piano_hands)
+    def measures():
+        for count, index, measure in iter_measure_tags(data):
+            if index not in staff_counts:
+                staff_counts[index] = staff_count(lxml_measure_to_elements(measure))
+            if index == part_index or last and index > part_index:
+                yield Measure(count, index, measure.get('number'), lxml_measure_to_elements(measure))
+            elif index > part_index: # the first measure of the next part is all that is needed from it
+                return
+
+    tokens = []
+    for (_, index), part in itertools.groupby(measures(), key=lambda m: m[:2]):
+        tokens += iter_part_tokens(part, part_count, index, note_name, hands=piano_hands(part_count, staff_counts))
+    return label_hands(tokens) if piano_hands(part_count, staff_counts) else tokens
+
+def parallel_MusicXML_to_tokens(source, note_name=True, workers=None, pool=None): # same tokens as MusicXML_to_tokens; each part is tokenized in its own worker
+    data = read_score_bytes(source) # as stored (e.g. still compressed), so sending it to the workers is cheap
+    part_count = score_part_count(data)
+    if part_count <= 1 or workers == 1: # nothing to parallelize
+        return stream_MusicXML_to_tokens(data, note_name)
+
+    with contextlib.ExitStack() as stack:
+        if pool is None:
+            pool = stack.enter_context(Pool(min(workers or part_count, part_count)))
+        results = pool.map(part_to_tokens, [(data, part_count, part_index, note_name) for part_index in range(part_count)], chunksize=1)
+        return join_measure_tokens(measure for part in results for measure in part)
+
+def prescan_score(data): # part_count and, per <part>, (measure count, {measure position: elements}) of its first measure and the measures setting <divisions>, the only state carried across measures
+    part_count, parts = 0, {} # streamed, one <measure> in memory at a time
+    for part_count, part_index, measure in iter_measure_tags(data):
+        count, changes = parts.setdefault(part_index, [0, {}])
+        if not count or measure.find('attributes/divisions') is not None:
+            changes[count] = lxml_measure_to_elements(measure)
+        parts[part_index][0] = count + 1
+    return part_count, [tuple(parts.get(part_index, (0, {}))) for part_index in range(max(parts, default=-1) + 1)]
+
+def divisions_at(starts, changes, staves): # incoming divisions per staff at each measure position in 'starts' (ascending), replaying only the measures in 'changes'
+    state, result, changes = None, [], sorted(changes.items())
+    for start in starts:
+        while changes and changes[0][0] < start:
+            _, state = measure_to_staff_tokens(changes.pop(0)[1], staves, state)
+        result.append(state)
+    return result
+
+def measure_range_to_tokens(job): # worker: (score bytes, part_count, part_index, [start, end), staves, labels, divisions, note_name) -> MeasureTokens of those measures
+    data, part_count, part_index, start, end, staves, labels, divisions, note_name = job
+    def measures(): # Measures in [start, end) of the part, streamed; parsing stops after the range
+        position = 0
+        for _, index, measure in iter_measure_tags(data):
+            if index < part_index:
+                continue
+            if index > part_index or position >= end:
+                return
+            if position >= start:
+                yield Measure(part_count, index, measure.get('number'), lxml_measure_to_elements(measure))
+            position += 1
+
+    measures, numbered = itertools.tee(measures())
+    tokens = []
+    for measure, staff_tokens in zip(numbered, iter_staff_tokens((m.elements for m in measures), staves, note_name, divisions=divisions)):
+        tokens += [MeasureTokens(part_index, measure.number, label, measure_tokens) for label, measure_tokens in zip(labels, staff_tokens)]
+    return tokens
+
+def measure_parallel_MusicXML_to_tokens(source, note_name=True, workers=None, pool=None, min_measures=32): # same tokens as MusicXML_to_tokens; measure ranges of long scores are tokenized in parallel workers
+    data = read_score_bytes(source)
+    part_count, parts = prescan_score(data)
+    total = sum(count for count, _ in parts)
+    workers = workers or os.cpu_count() or 1
+    range_count = min(workers, total // min_measures)
+    if range_count <= 1: # too short to split
+        return stream_MusicXML_to_tokens(data, note_name)
+
+    jobs = []
+    hands = piano_hands(part_count, {part_index: staff_count(changes[0]) for part_index, (count, changes) in enumerate(parts) if count})
+    for part_index, (count, changes) in enumerate(parts):
+        if not count:
+            continue
+        staves, labels = part_staves(part_count, part_index, staff_count(changes[0]), hands)
+        ranges = max(1, round(range_count * count / total)) # one contiguous range per worker, spread over the parts by length
+        bounds = [count * i // ranges for i in range(ranges + 1)]
+        for (start, end), divisions in zip(zip(bounds, bounds[1:]), divisions_at(bounds[:-1], changes, staves)):
+            jobs.append((data, part_count, part_index, start, end, staves, labels, divisions, note_name))
+
+    with contextlib.ExitStack() as stack:
+        if pool is None:
+            pool = stack.enter_context(Pool(workers))
+        results = pool.map(measure_range_to_tokens, jobs, chunksize=1)
+        return join_measure_tokens(measure for tokens in results for measure in tokens)
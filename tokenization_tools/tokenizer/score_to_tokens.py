@@ -1,8 +1,30 @@
 from bs4 import BeautifulSoup
 from bs4.element import Tag
+from collections import namedtuple
 from fractions import Fraction
+from lxml import etree
+import contextlib
+import functools
+import gzip
+import heapq
+import io
+import itertools
+import os
+import sys
+import zipfile
 import pretty_midi
 
+TOKENIZER_VERSION = 4 # bump whenever the emitted tokens change (invalidates cached tokens); see 'Tokenizer versions' in README.md
+VIEWS = {'note_name': (True, False), 'midi': (False, False), 'concatenated': (True, True), 'concatenated_midi': (False, True)} # token variants: view -> (note_name, concatenated)
+
+# plain views of <note>, <attributes> and <backup>/<forward>, shared by the BeautifulSoup and lxml backends
+NoteElement = namedtuple('NoteElement', ['pitches', 'duration', 'voice', 'staff', 'chord', 'rest', 'stem', 'beams', 'tie'])
+AttributesElement = namedtuple('AttributesElement', ['divisions', 'signatures', 'staves']) # signatures: [(number, token), ...]; staves: <staves> or None
+ShiftElement = namedtuple('ShiftElement', ['duration']) # negative for <backup>
+MeasureIndex = namedtuple('MeasureIndex', ['onsets', 'offsets', 'voices', 'staves']) # one entry per element of a measure
+Measure = namedtuple('Measure', ['part_count', 'part', 'number', 'elements']) # as read by iter_MusicXML_measures
+MeasureTokens = namedtuple('MeasureTokens', ['part', 'number', 'staff', 'tokens']) # staff: 'R' or 'L'
+
 def attributes_to_tokens(attributes, staff=None): # tokenize 'attributes' section in MusicXML
     tokens = []
     divisions = None
@@ -22,233 +44,556 @@ def attributes_to_tokens(attributes, staff=None): # tokenize 'attributes' sectio
 def attribute_to_token(child): # clef, key signature, and time signature
     type_ = child.name
     if type_ == 'clef':
-        if child.sign.text == 'G':
-            return 'clef_treble'
-        elif child.sign.text == 'F':
-            return 'clef_bass'
+        return clef_to_token(child.sign.text)
     elif type_ == 'key':
-        key = int(child.fifths.text)
-        if key < 0:
-            return f'key_flat_{abs(key)}'
-        elif key > 0:
-            return f'key_sharp_{key}'
-        else:
-            return f'key_natural_{key}'
+        return key_to_token(int(child.fifths.text))
     elif type_ == 'time':
-        times = [int(c.text) for c in child.contents if isinstance(c, Tag)] # excluding '\n'
-        if times[1] == 2:
-            return f'time_{times[0]*2}/{times[1]*2}'
-        elif times[1] > 4:
-            fraction = str(Fraction(times[0], times[1]))
-            if int(fraction.split('/')[1]) == 2: # X/2
-                return f"time_{int(fraction.split('/')[0])*2}/{int(fraction.split('/')[0])*2}"
-            else:
-                return 'time_' + fraction
+        return time_to_token([int(c.text) for c in child.contents if isinstance(c, Tag)]) # excluding '\n'
+
+def clef_to_token(sign):
+    if sign == 'G':
+        return 'clef_treble'
+    elif sign == 'F':
+        return 'clef_bass'
+
+def key_to_token(key):
+    if key < 0:
+        return f'key_flat_{abs(key)}'
+    elif key > 0:
+        return f'key_sharp_{key}'
+    else:
+        return f'key_natural_{key}'
+
+def time_to_token(times):
+    if times[1] == 2:
+        return f'time_{times[0]*2}/{times[1]*2}'
+    elif times[1] > 4:
+        fraction = str(Fraction(times[0], times[1]))
+        if int(fraction.split('/')[1]) == 2: # X/2
+            return f"time_{int(fraction.split('/')[0])*2}/{int(fraction.split('/')[0])*2}"
         else:
-            return f'time_{times[0]}/{times[1]}'
-
-def aggregate_notes(voice_notes): # notes to chord
-    for note in voice_notes[1:]:
-        if note.chord is not None:
-            last_note = note.find_previous('note')
-            last_note.insert(0, note.pitch)
-            note.decompose()
+            return 'time_' + fraction
+    else:
+        return f'time_{times[0]}/{times[1]}'
 
 def note_to_tokens(note, divisions=8, note_name=True): # notes and rests
-    beam_translations = {'begin': 'start', 'end': 'stop', 'forward hook': 'partial-right', 'backward hook': 'partial-left'}
+    return note_element_to_tokens(note_tag_to_element(note), divisions, note_name)
+
+def note_tag_to_element(note): # BeautifulSoup <note> -> NoteElement, in one scan over its children
+    children, pitches, beams, tie = {}, [], [], None
+    for child in note.children:
+        if child.name == 'pitch':
+            pitch = {c.name: c.text for c in child.children if c.name is not None}
+            pitches.append((pitch.get('step'), pitch.get('alter'), pitch.get('octave')))
+        elif child.name == 'beam':
+            beams.append(child.text)
+        elif child.name == 'notations':
+            if tie is None:
+                tied = child.find('tied')
+                tie = tied.attrs['type'] if tied else None
+        elif child.name is not None and child.name not in children:
+            children[child.name] = child
+
+    return NoteElement(
+        pitches=pitches,
+        duration=int(children['duration'].text) if 'duration' in children else None,
+        voice=children['voice'].text if 'voice' in children else None,
+        staff=int(children['staff'].text) if 'staff' in children else None,
+        chord='chord' in children,
+        rest='rest' in children,
+        stem=children['stem'].text if 'stem' in children else None,
+        beams=beams,
+        tie=tie,
+    )
+
+BEAM_TRANSLATIONS = {'begin': 'start', 'end': 'stop', 'forward hook': 'partial-right', 'backward hook': 'partial-left'}
+ALTER_TO_SYMBOL = {'-2': 'bb', '-1': 'b', '0': '', '1': '#', '2': '##'}
+
+@functools.lru_cache(maxsize=None)
+def pitch_to_token(pitch, note_name=True): # (step, alter, octave) -> 'note_C#4' or 'note_61'
+    step, alter, octave = pitch
+    if note_name:
+        return f"note_{step}{ALTER_TO_SYMBOL[alter] if alter is not None else ''}{octave}"
+    note_number = pretty_midi.note_name_to_number(step + octave) # 'C4' -> 60
+    if alter is not None:
+        note_number += int(alter)
+    return f'note_{note_number}'
+
+@functools.lru_cache(maxsize=None)
+def duration_to_token(duration, divisions): # 'len_' + length in quarter notes
+    return f'len_{Fraction(duration, divisions)}'
+
+@functools.lru_cache(maxsize=None)
+def beams_to_token(beams): # tuple of <beam> values -> 'beam_start_partial-right'
+    return 'beam_' + '_'.join([BEAM_TRANSLATIONS.get(b, b) for b in beams])
+
+def concatenated_note_tokens(note, divisions=8, note_name=True): # note_element_to_tokens with length, stem and beam in one token ('len_1/2_up_start'), as read by concatenated_to_regular
+    tokens = note_element_to_tokens(note, divisions, note_name)
+    if note.rest or note.stem is None or not tokens: # a beam without a stem stays a separate token
+        return tokens
+    length = len(note.pitches)
+    if note.beams:
+        tokens[length:length + 3] = [f'{tokens[length]}_{note.stem}_{tokens[length + 2][5:]}']
+    else:
+        tokens[length:length + 2] = [f'{tokens[length]}_{note.stem}']
+    return tokens
 
+def note_element_to_tokens(note, divisions=8, note_name=True):
     if note.duration is None: # gracenote
         return []
 
-    duration_in_fraction = str(Fraction(int(note.duration.text), divisions))
-
     if note.rest:
-        return ['rest', f'len_{duration_in_fraction}'] # for rests
+        return ['rest', duration_to_token(note.duration, divisions)] # for rests
 
-    tokens = []
+    tokens = [pitch_to_token(pitch, note_name) for pitch in note.pitches]
+    tokens.append(duration_to_token(note.duration, divisions))
 
-    # pitches
-    for pitch in note.find_all('pitch'):
-        if note_name:
-            if pitch.alter:
-                alter_to_symbol= {'-2': 'bb', '-1': 'b', '0':'', '1': '#', '2': '##'}
-                tokens.append(f"note_{pitch.step.text}{alter_to_symbol[pitch.alter.text]}{pitch.octave.text}")
-            else:
-                tokens.append(f"note_{pitch.step.text}{pitch.octave.text}")
-        else:
-            note_number = pretty_midi.note_name_to_number(pitch.step.text + pitch.octave.text) # 'C4' -> 60
-            if pitch.alter:
-                note_number += int(pitch.alter.text)
-            tokens.append(f'note_{note_number}')
+    if note.stem is not None:
+        tokens.append(f'stem_{note.stem}')
 
-    # len
-    tokens.append(f'len_{duration_in_fraction}')
+    if note.beams:
+        tokens.append(beams_to_token(tuple(note.beams)))
 
-    if note.stem:
-        tokens.append(f'stem_{note.stem.text}')
-
-    if note.beam:
-        beams = note.find_all('beam')
-        tokens.append('beam_' + '_'.join([beam_translations[b.text] if b.text in beam_translations else b.text for b in beams]))
-
-    if note.tied:
-        tokens.append('tie_' + note.tied.attrs['type'])
+    if note.tie is not None:
+        tokens.append('tie_' + note.tie)
 
     return tokens
 
-def element_segmentation(measure, soup, staff=None): # divide elements into three sections
-    voice_starts, voice_ends = {}, {}
-    position = 0
-    for element in measure.contents:
+def attributes_tag_to_element(attributes): # BeautifulSoup <attributes> -> AttributesElement
+    divisions, signatures, staves = None, [], None
+    for child in attributes.find_all(['divisions', 'clef', 'key', 'time', 'staves'], recursive=False):
+        if child.name == 'divisions':
+            divisions = int(child.text)
+        elif child.name == 'staves':
+            staves = int(child.text)
+        else:
+            signatures.append((int(child['number']) if 'number' in child.attrs else None, attribute_to_token(child)))
+    return AttributesElement(divisions, signatures, staves)
+
+def measure_tag_to_elements(measure): # BeautifulSoup <measure> -> list of elements (the tree is left untouched)
+    elements = []
+    for element in measure.children:
         if element.name == 'note':
+            elements.append(note_tag_to_element(element))
+        elif element.name == 'attributes':
+            elements.append(attributes_tag_to_element(element))
+        elif element.name == 'backup':
+            elements.append(ShiftElement(-int(element.duration.text)))
+        elif element.name == 'forward':
+            elements.append(ShiftElement(int(element.duration.text)))
+    return elements
+
+def element_segmentation(measure, soup=None, staff=None): # divide elements into three sections (the tree is left untouched)
+    tags = [tag for tag in measure.children if tag.name is not None]
+    elements = []
+    for tag in tags:
+        if tag.name == 'note':
+            elements.append(note_tag_to_element(tag))
+        elif tag.name in ('backup', 'forward'):
+            elements.append(ShiftElement(int(tag.duration.text) * (-1 if tag.name == 'backup' else 1)))
+        else: # other types
+            elements.append(None)
+
+    index = index_measure(elements)
+    for i, tag in enumerate(tags): # <direction> etc. are filtered by <staff> too
+        if elements[i] is None and tag.staff:
+            index.staves[i] = int(tag.staff.text)
+    return tuple([tags[i] for i in section] for section in segment_elements(index, staff))
+
+def index_measure(elements): # integer onsets / offsets (None for gracenotes and <backup>/<forward>), voices and staves of the elements
+    onsets, offsets, voices, staves = [], [], [], []
+    position = last_duration = 0
+    for element in elements:
+        type_ = type(element)
+        if type_ is NoteElement:
+            voices.append(element.voice)
+            staves.append(element.staff)
             if element.duration is None: # gracenote
+                onsets.append(None)
+                offsets.append(None)
                 continue
-
-            voice = element.voice.text
-            duration = int(element.duration.text)
             if element.chord: # rewind for concurrent notes
                 position -= last_duration
+            onsets.append(position)
+            position += element.duration
+            offsets.append(position)
+            last_duration = element.duration
+            continue
 
-            if element.staff and int(element.staff.text) == staff:
-                voice_starts[voice] = min(voice_starts[voice], position) if voice in voice_starts else position
-                start_tag = soup.new_tag('start')
-                start_tag.string = str(position)
-                element.append(start_tag)
-
-            position += duration
-
-            if element.staff and int(element.staff.text) == staff:
-                voice_ends[voice] = max(voice_ends[voice], position) if voice in voice_ends else position
-                end_tag = soup.new_tag('end')
-                end_tag.string = str(position)
-                element.append(end_tag)
-
-            last_duration = duration
-        elif element.name == 'backup':
-            position -= int(element.duration.text)
-        elif element.name == 'forward':
-            position += int(element.duration.text)
+        voices.append(None)
+        staves.append(None)
+        if type_ is ShiftElement:
+            position += element.duration
+            onsets.append(None)
+            offsets.append(None)
         else: # other types
-            start_tag = soup.new_tag('start')
-            end_tag = soup.new_tag('end')
-
-            start_tag.string = str(position)
-            end_tag.string = str(position)
+            onsets.append(position)
+            offsets.append(position)
 
-            element.append(start_tag)
-            element.append(end_tag)
+    return MeasureIndex(onsets, offsets, voices, staves)
 
-    # voice section
-    voice_start = sorted(voice_starts.values())[1] if voice_starts else 0
-    voice_end = sorted(voice_ends.values(), reverse=True)[1] if voice_ends else 0
-
-    pre_voice_elements, post_voice_elements, voice_elements = [], [], []
-    for element in measure.contents:
-        if element.name in ('backup', 'forward'):
+def segment_elements(index, staff=None): # divide element positions into pre-voice, voice and post-voice sections
+    voice_starts, voice_ends = {}, {}
+    if staff is not None:
+        for onset, offset, voice, staff_ in zip(index.onsets, index.offsets, index.voices, index.staves):
+            if staff_ == staff and onset is not None and voice is not None:
+                if voice not in voice_starts:
+                    voice_starts[voice], voice_ends[voice] = onset, offset
+                else:
+                    voice_starts[voice] = min(voice_starts[voice], onset)
+                    voice_ends[voice] = max(voice_ends[voice], offset)
+
+    # voice section: from the second earliest voice start to the second latest voice end
+    voice_start = heapq.nsmallest(2, voice_starts.values())[-1] if voice_starts else 0
+    voice_end = heapq.nlargest(2, voice_ends.values())[-1] if voice_ends else 0
+
+    pre_voice, voice_section, post_voice = [], [], []
+    for i, (onset, offset, staff_) in enumerate(zip(index.onsets, index.offsets, index.staves)):
+        if onset is None:
             continue
-        if element.name == 'note' and element.duration is None: # gracenote
+        if staff is not None and staff_ is not None and staff_ != staff:
             continue
-        if staff is not None:
-            if element.staff and int(element.staff.text) != staff:
-                continue
 
-        if voice_starts or voice_ends:
-            if int(element.end.text) <= voice_start:
-                pre_voice_elements.append(element)
-            elif voice_end <= int(element.start.text):
-                post_voice_elements.append(element)
-            else:
-                voice_elements.append(element)
+        if not voice_starts:
+            pre_voice.append(i)
+        elif offset <= voice_start:
+            pre_voice.append(i)
+        elif voice_end <= onset:
+            post_voice.append(i)
         else:
-            pre_voice_elements.append(element)
+            voice_section.append(i)
+
+    return pre_voice, voice_section, post_voice
+
+def attributes_element_to_tokens(attributes, staff=None):
+    tokens = [token for number, token in attributes.signatures if staff is None or number is None or number == staff]
+    return tokens, attributes.divisions
+
+def collapse_chords(elements, staves=(None,)): # notes to chord for all staves in one forward pass, without modifying the elements
+    collapsed, first_notes = [], set()
+    all_staves = None in staves
+    last_note = None
+    for element in elements:
+        if type(element) is NoteElement:
+            if element.voice is not None and (all_staves or element.staff in staves):
+                voice = (None if all_staves else element.staff, element.voice)
+                if element.chord and voice in first_notes:
+                    if last_note is not None:
+                        collapsed[last_note] = collapsed[last_note]._replace(pitches=element.pitches[:1] + collapsed[last_note].pitches)
+                    continue
+                first_notes.add(voice)
+            last_note = len(collapsed)
+        collapsed.append(element)
+    return collapsed
 
-    return pre_voice_elements, voice_elements, post_voice_elements
+def staff_layout(elements, staff=None, index=None): # elements of one staff of a chord-collapsed measure in emission order, with '<voice>' / '</voice>' markers
+    notes = [e for e in elements if type(e) is NoteElement and (staff is None or e.staff == staff)]
+    voices = list(dict.fromkeys([n.voice for n in notes if n.voice is not None])) # in order of appearance
 
-def measures_to_tokens(measures, soup, staff=None, note_name=True):
-    divisions = 0
-    tokens = []
-    for measure in measures:
+    if len(voices) <= 1:
+        return [e for e in elements if staff is None or type(e) is not NoteElement or e.staff is None or e.staff == staff]
 
-        tokens.append('bar')
-        if staff is not None:
-            notes = [n for n in measure.find_all('note') if n.staff and int(n.staff.text) == staff]
-        else:
-            notes = measure.find_all('note')
+    if index is None:
+        index = index_measure(elements)
+    pre_voice, voice_section, post_voice = ([elements[i] for i in section] for section in segment_elements(index, staff))
 
-        voices = list(set([n.voice.text for n in notes if n.voice]))
+    layout = pre_voice
+    if voice_section:
         for voice in voices:
-            voice_notes = [n for n in notes if n.voice and n.voice.text == voice]
-            aggregate_notes(voice_notes)
-
-        if len(voices) > 1:
-            pre_voice_elements, voice_elements, post_voice_elements = element_segmentation(measure, soup, staff)
-
-            for element in pre_voice_elements:
-                if element.name == 'attributes':
-                    attr_tokens, div = attributes_to_tokens(element, staff)
-                    tokens += attr_tokens
-                    divisions = div if div else divisions
-                elif element.name == 'note':
-                    tokens += note_to_tokens(element, divisions, note_name)
-
-            if voice_elements:
-                for voice in voices:
-                    tokens.append('<voice>')
-                    for element in voice_elements:
-                        if (element.voice and element.voice.text == voice) or (not element.voice and voice == '1'):
-                            if element.name == 'attributes':
-                                attr_tokens, div = attributes_to_tokens(element, staff)
-                                tokens += attr_tokens
-                                divisions = div if div else divisions
-                            elif element.name == 'note':
-                                tokens += note_to_tokens(element, divisions, note_name)
-                    tokens.append('</voice>')
-
-            for element in post_voice_elements:
-                if element.name == 'attributes':
-                    attr_tokens, div = attributes_to_tokens(element, staff)
-                    tokens += attr_tokens
-                    divisions = div if div else divisions
-                elif element.name == 'note':
-                    tokens += note_to_tokens(element, divisions, note_name)
+            layout.append('<voice>')
+            for element in voice_section:
+                element_voice = element.voice if type(element) is NoteElement else None
+                if element_voice == voice or (element_voice is None and voice == '1'):
+                    layout.append(element)
+            layout.append('</voice>')
+    return layout + post_voice
+
+def layout_to_tokens(layout, staff=None, divisions=0, note_name=True, vocabulary=None, concatenated=False): # emit the tokens of a staff_layout, carrying 'divisions' over; with a Vocabulary, token IDs (array) are emitted instead
+    if vocabulary is None:
+        tokens, voice_start, voice_end = ['bar'], '<voice>', '</voice>'
+        note_tokens, signature_tokens = (concatenated_note_tokens if concatenated else note_element_to_tokens), None
+    else:
+        tokens, voice_start, voice_end = vocabulary.new_buffer([vocabulary.bar_id]), vocabulary.voice_start_id, vocabulary.voice_end_id
+        note_tokens, signature_tokens = vocabulary.note_ids, vocabulary.encode
+
+    for element in layout:
+        type_ = type(element)
+        if type_ is NoteElement:
+            tokens.extend(note_tokens(element, divisions, note_name))
+        elif type_ is AttributesElement:
+            attr_tokens, div = attributes_element_to_tokens(element, staff)
+            tokens.extend(attr_tokens if signature_tokens is None else signature_tokens(attr_tokens))
+            divisions = div if div else divisions
+        elif type_ is str:
+            tokens.append(voice_start if element == '<voice>' else voice_end)
+
+    return tokens, divisions
+
+def measure_elements_to_tokens(elements, staff=None, divisions=0, note_name=True, index=None, vocabulary=None): # tokenize one staff of a chord-collapsed measure, carrying 'divisions' over
+    return layout_to_tokens(staff_layout(elements, staff, index), staff, divisions, note_name, vocabulary)
+
+def measure_to_staff_tokens(elements, staves=(None,), divisions=None, note_name=True, vocabulary=None): # tokenize all staves of one measure; 'divisions' is the incoming state per staff
+    elements = collapse_chords(elements, staves)
+    index = index_measure(elements) if len(staves) > 1 else None # shared by the staves
+    staff_tokens, divisions = [], list(divisions or [0] * len(staves))
+    for i, staff in enumerate(staves):
+        measure_tokens, divisions[i] = measure_elements_to_tokens(elements, staff, divisions[i], note_name, index, vocabulary)
+        staff_tokens.append(measure_tokens)
+    return staff_tokens, tuple(divisions)
+
+def measure_to_staff_views(elements, staves=(None,), divisions=None, views=('note_name',)): # like measure_to_staff_tokens, but {view: tokens} per staff; chord collapsing and segmentation are shared by the views
+    elements = collapse_chords(elements, staves)
+    index = index_measure(elements) if len(staves) > 1 else None
+    staff_views, divisions = [], list(divisions or [0] * len(staves))
+    for i, staff in enumerate(staves):
+        layout, tokens = staff_layout(elements, staff, index), {}
+        for view in views:
+            note_name, concatenated = VIEWS[view]
+            tokens[view], div = layout_to_tokens(layout, staff, divisions[i], note_name, concatenated=concatenated)
+        divisions[i] = div # the same for every view
+        staff_views.append(tokens)
+    return staff_views, tuple(divisions)
+
+def iter_staff_tokens(measures, staves=(None,), note_name=True, vocabulary=None, views=None, divisions=None): # single traversal over measures (element lists); yield one token list (or {view: tokens}) per staff for each measure; 'divisions' is the incoming state per staff
+    for elements in measures:
+        if views is None:
+            staff_tokens, divisions = measure_to_staff_tokens(elements, staves, divisions, note_name, vocabulary)
         else:
-            for element in measure.contents:
-                if staff is not None:
-                    if element.name in ('attributes', 'note') and element.staff and int(element.staff.text) != staff:
-                        continue
-                if element.name == 'attributes':
-                    attr_tokens, div = attributes_to_tokens(element, staff)
-                    tokens += attr_tokens
-                    divisions = div if div else divisions
-                elif element.name == 'note':
-                    tokens += note_to_tokens(element, divisions, note_name)
+            staff_tokens, divisions = measure_to_staff_views(elements, staves, divisions, views)
+        yield staff_tokens
+
+def measures_to_staff_tokens(measures, staves=(None,), note_name=True): # one token list per staff
+    tokens = [[] for _ in staves]
+    for staff_tokens in iter_staff_tokens(measures, staves, note_name):
+        for staff_list, measure_tokens in zip(tokens, staff_tokens):
+            staff_list += measure_tokens
+    return tokens
 
+def measures_to_staff_views(measures, staves=(None,), views=('note_name',)): # {view: one token list per staff}
+    tokens = {view: [[] for _ in staves] for view in views}
+    for staff_views in iter_staff_tokens(measures, staves, views=views):
+        for i, measure_views in enumerate(staff_views):
+            for view, measure_tokens in measure_views.items():
+                tokens[view][i] += measure_tokens
     return tokens
 
-def load_MusicXML(mxml_path): # load MusicXML contents using BeautifulSoup
-    soup = BeautifulSoup(open(mxml_path, encoding='utf-8'), 'lxml-xml', from_encoding='utf-8') # MusicXML
-    for tag in soup(string='\n'): # eliminate line breaks
-        tag.extract()
+def measures_to_tokens(measures, soup=None, staff=None, note_name=True):
+    return measures_to_staff_tokens(map(measure_tag_to_elements, measures), (staff,), note_name)[0]
+
+@contextlib.contextmanager
+def open_MusicXML(source): # path, '-' (stdin), bytes or file-like object of MusicXML / .mxl / gzipped MusicXML -> binary stream of the MusicXML document
+    with contextlib.ExitStack() as stack:
+        if isinstance(source, (bytes, bytearray)):
+            f = io.BytesIO(source)
+        elif source == '-':
+            f = sys.stdin.buffer
+        elif isinstance(source, (str, os.PathLike)):
+            f = stack.enter_context(open(source, 'rb'))
+        else:
+            f = getattr(source, 'buffer', source) # text streams such as sys.stdin
 
+        if hasattr(f, 'peek'):
+            magic = f.peek(4)[:4]
+        else:
+            if not f.seekable():
+                f = io.BytesIO(f.read())
+            magic = f.read(4)
+            f.seek(-len(magic), io.SEEK_CUR)
+
+        if magic == b'PK\x03\x04': # compressed MusicXML (.mxl)
+            if not f.seekable():
+                f = io.BytesIO(f.read())
+            archive = stack.enter_context(zipfile.ZipFile(f))
+            f = stack.enter_context(archive.open(mxl_rootfile(archive)))
+        elif magic[:2] == b'\x1f\x8b': # gzip
+            f = stack.enter_context(gzip.open(f))
+        yield f
+
+class UnsupportedScore(ValueError): # inputs that are not scores the tokenizer reads (recorded as skipped, not failed, by batch_tokenize)
+    pass
+
+def mxl_rootfile(archive): # name of the score in a .mxl archive (META-INF/container.xml)
+    if 'META-INF/container.xml' in archive.namelist():
+        container = etree.fromstring(archive.read('META-INF/container.xml'))
+        for rootfile in container.iter('{*}rootfile'):
+            if rootfile.get('media-type', 'application/vnd.recordare.musicxml+xml') == 'application/vnd.recordare.musicxml+xml':
+                return rootfile.get('full-path')
+    for name in archive.namelist():
+        if not name.startswith('META-INF/') and name.lower().endswith(('.musicxml', '.xml')):
+            return name
+    raise UnsupportedScore('no MusicXML document in the archive')
+
+def load_MusicXML(mxml_path): # load MusicXML contents using BeautifulSoup
+    with open_MusicXML(mxml_path) as f:
+        soup = BeautifulSoup(f, 'lxml-xml', from_encoding='utf-8') # MusicXML
     parts = soup.find_all('part')
 
     return [part.find_all('measure') for part in parts], soup
 
-def MusicXML_to_tokens(soup_or_mxml_path, note_name=True): # use this method
-    if type(soup_or_mxml_path) is str:
+def MusicXML_to_tokens(soup_or_mxml_path, note_name=True, views=None, merges=None): # use this method; with 'views' (names in VIEWS), {view: tokens} from a single traversal; 'merges': token_merges.TokenMerges to apply
+    if not isinstance(soup_or_mxml_path, Tag): # path, bytes or file-like object
         parts, soup = load_MusicXML(soup_or_mxml_path)
     else:
         soup = soup_or_mxml_path
-        for tag in soup(string='\n'): # eliminate line breaks
-            tag.extract()
-
         parts = [part.find_all('measure') for part in soup.find_all('part')]
 
-    if len(parts) == 1:
-        tokens = ['R'] + measures_to_tokens(parts[0], soup, staff=1, note_name=note_name)
-        tokens += ['L'] + measures_to_tokens(parts[0], soup, staff=2, note_name=note_name)
-    elif len(parts) == 2:
-        tokens = ['R'] + measures_to_tokens(parts[0], soup, note_name=note_name)
-        tokens += ['L'] + measures_to_tokens(parts[1], soup, note_name=note_name)
+    tokens = {view: [] for view in views or (None,)}
+    hands = piano_hands(len(parts), {part_index: staff_count(measure_tag_to_elements(measures[0])) if measures else 1 for part_index, measures in enumerate(parts)})
+    for part_index, measures in enumerate(parts):
+        measures = [measure_tag_to_elements(measure) for measure in measures]
+        staves, labels = part_staves(len(parts), part_index, staff_count(measures[0]) if measures else 1, hands)
+        view_tokens = measures_to_staff_views(measures, staves, views) if views else {None: measures_to_staff_tokens(measures, staves, note_name)}
+        for view, staff_tokens in view_tokens.items():
+            for label, label_tokens in zip(labels, staff_tokens):
+                tokens[view] += [label] + label_tokens
+
+    if merges is not None:
+        tokens = {view: merges.apply(view_tokens) for view, view_tokens in tokens.items()}
+    return tokens if views else tokens[None]
+
+# streaming backend (lxml.etree.iterparse): one <measure> in memory at a time
+
+def lxml_note_to_element(note): # lxml <note> -> NoteElement, in one pass over its children
+    children, pitches, beams, tie = {}, [], [], None
+    for child in note:
+        tag = child.tag
+        if tag == 'pitch':
+            pitch = {c.tag: c.text or '' for c in child}
+            pitches.append((pitch.get('step'), pitch.get('alter'), pitch.get('octave')))
+        elif tag == 'beam':
+            beams.append(child.text or '')
+        elif tag == 'notations':
+            if tie is None:
+                tied = child.find('tied')
+                tie = tied.get('type') if tied is not None else None
+        elif tag not in children:
+            children[tag] = child.text or ''
+
+    return NoteElement(
+        pitches=pitches,
+        duration=int(children['duration']) if 'duration' in children else None,
+        voice=children.get('voice'),
+        staff=int(children['staff']) if 'staff' in children else None,
+        chord='chord' in children,
+        rest='rest' in children,
+        stem=children.get('stem'),
+        beams=beams,
+        tie=tie,
+    )
+
+def lxml_attributes_to_element(attributes): # lxml <attributes> -> AttributesElement
+    divisions, signatures, staves = None, [], None
+    for child in attributes.iterchildren('divisions', 'clef', 'key', 'time', 'staves'):
+        if child.tag == 'divisions':
+            divisions = int(child.text)
+            continue
+        elif child.tag == 'staves':
+            staves = int(child.text)
+            continue
+        elif child.tag == 'clef':
+            token = clef_to_token(child.findtext('.//sign'))
+        elif child.tag == 'key':
+            token = key_to_token(int(child.findtext('.//fifths')))
+        else:
+            token = time_to_token([int(c.text) for c in child.iterchildren(tag=etree.Element)])
+        number = child.get('number')
+        signatures.append((int(number) if number is not None else None, token))
+    return AttributesElement(divisions, signatures, staves)
+
+def lxml_measure_to_elements(measure):
+    elements = []
+    for element in measure.iterchildren('note', 'attributes', 'backup', 'forward'):
+        if element.tag == 'note':
+            elements.append(lxml_note_to_element(element))
+        elif element.tag == 'attributes':
+            elements.append(lxml_attributes_to_element(element))
+        elif element.tag == 'backup':
+            elements.append(ShiftElement(-int(element.findtext('duration'))))
+        else:
+            elements.append(ShiftElement(int(element.findtext('duration'))))
+    return elements
+
+def iter_measure_tags(source): # yield (part_count, part_index, lxml <measure>) for each <measure>, releasing the element once the next one is asked for
+    part_count, part_index = 0, -1
+    with open_MusicXML(source) as f:
+        for event, element in etree.iterparse(f, events=('start', 'end'), tag=('part-list', 'part', 'measure')):
+            if event == 'start':
+                if element.tag == 'part':
+                    part_index += 1
+                continue
 
-    return tokens
+            if element.tag == 'part-list':
+                part_count = len(element.findall('score-part'))
+            elif element.tag == 'measure':
+                yield part_count, part_index, element
+                element.clear()
+                while element.getprevious() is not None: # drop already processed siblings
+                    del element.getparent()[0]
+            else: # part
+                element.clear()
+
+def iter_MusicXML_measures(source): # yield a Measure for each <measure>, releasing the element afterwards
+    for part_count, part_index, measure in iter_measure_tags(source):
+        yield Measure(part_count, part_index, measure.get('number'), lxml_measure_to_elements(measure))
+
+def staff_count(elements): # <staves> of the first measure of a part (1 if not given)
+    return max([e.staves for e in elements if type(e) is AttributesElement and e.staves], default=1)
+
+def part_staves(part_count, part_index, staff_count=1, hands=False): # staves to tokenize in a part, and their section tokens; hands: see piano_hands
+    if part_count == 1 and staff_count <= 2: # piano
+        return (1, 2), ('R', 'L')
+    elif hands: # piano, one part per hand
+        return (None,), ('RL'[part_index],)
+    elif staff_count == 1:
+        return (None,), (f'part_{part_index + 1}',)
+    return tuple(range(1, staff_count + 1)), tuple(f'part_{part_index + 1}_staff_{staff}' for staff in range(1, staff_count + 1))
+
+def piano_hands(part_count, staff_counts): # two parts of one staff each (staff_counts: part index -> staff count) are a piano, one part per hand; not e.g. a violin + piano duo
+    return part_count == 2 and staff_counts.get(0) == staff_counts.get(1) == 1
+
+def label_hands(measures): # MeasureTokens of a piano_hands score tokenized before its second part was seen: 'part_1' / 'part_2' -> 'R' / 'L'
+    return [measure._replace(staff='RL'[measure.part]) for measure in measures]
+
+def iter_part_tokens(measures, part_count, part_index, note_name=True, vocabulary=None, views=None, hands=False): # Measures of one part -> MeasureTokens
+    measures = iter(measures)
+    first = next(measures, None)
+    if first is None:
+        return
+    staves, labels = part_staves(part_count, part_index, staff_count(first.elements), hands)
+    measures, numbered = itertools.tee(itertools.chain([first], measures))
+    for measure, staff_tokens in zip(numbered, iter_staff_tokens((m.elements for m in measures), staves, note_name, vocabulary, views)):
+        for label, tokens in zip(labels, staff_tokens):
+            yield MeasureTokens(part_index, measure.number, label, tokens)
+
+def iter_MusicXML_tokens(source, note_name=True, vocabulary=None, views=None): # lazily yield MeasureTokens (tokens of one staff of one measure, starting with 'bar'; {view: tokens} with 'views') as the score is parsed
+    return iter_score_tokens(iter_MusicXML_measures(source), note_name, vocabulary, views)
+
+def iter_score_tokens(measures, note_name=True, vocabulary=None, views=None): # Measures of a whole score (as iter_MusicXML_measures yields them) -> MeasureTokens of all its parts
+    staff_counts, held = {}, []
+    for (part_count, part_index), measures in itertools.groupby(measures, key=lambda m: m[:2]):
+        first = next(measures)
+        staff_counts[part_index] = staff_count(first.elements)
+        part_tokens = iter_part_tokens(itertools.chain([first], measures), part_count, part_index, note_name, vocabulary, views, piano_hands(part_count, staff_counts))
+        if part_count == 2 and part_index == 0 and staff_counts[0] == 1: # 'R' or 'part_1' depends on the staves of the second part: hold the tokens until its first measure
+            held = list(part_tokens)
+            continue
+        if held:
+            yield from label_hands(held) if piano_hands(part_count, staff_counts) else held
+            held = []
+        yield from part_tokens
+    yield from held
+
+def join_measure_tokens(measures, view=None): # MeasureTokens -> the token sequence of MusicXML_to_tokens (staves in order of appearance, each after its section token)
+    tokens = {}
+    for measure in measures:
+        if measure.staff not in tokens:
+            tokens[measure.staff] = [measure.staff]
+        tokens[measure.staff] += measure.tokens if view is None else measure.tokens[view]
+    return [token for staff_tokens in tokens.values() for token in staff_tokens]
+
+def stream_MusicXML_to_tokens(source, note_name=True, views=None, merges=None): # same tokens as MusicXML_to_tokens, with bounded memory
+    apply = merges.apply if merges is not None else list
+    if views:
+        measures = list(iter_MusicXML_tokens(source, views=views))
+        return {view: apply(join_measure_tokens(measures, view)) for view in views}
+    return apply(join_measure_tokens(iter_MusicXML_tokens(source, note_name)))
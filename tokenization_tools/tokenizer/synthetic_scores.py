@@ -0,0 +1,77 @@
+import random
+
+STEPS = 'CDEFGAB'
+DIVISIONS = 4 # per quarter note
+MEASURE_LENGTH = 4 * DIVISIONS # 4/4
+RHYTHMS = [[4, 4, 4, 4], [8, 8], [2, 2, 4, 8], [4, 2, 2, 4, 4], [16], [2, 2, 2, 2, 8], [12, 4], [1, 1, 2, 4, 8]] # in divisions, each sums to a measure
+TYPES = {1: '16th', 2: 'eighth', 4: 'quarter', 8: 'half', 12: 'half', 16: 'whole'}
+
+def note_xml(step, octave, alter, duration, voice, staff, chord=False, rest=False, stem=None, beam=None, tie=None):
+    xml = ['<note>']
+    if chord:
+        xml.append('<chord/>')
+    if rest:
+        xml.append('<rest/>')
+    else:
+        xml.append(f'<pitch><step>{step}</step>' + (f'<alter>{alter}</alter>' if alter else '') + f'<octave>{octave}</octave></pitch>')
+    xml.append(f'<duration>{duration}</duration>')
+    if tie:
+        xml.append(f'<tie type="{tie}"/>')
+    xml.append(f'<voice>{voice}</voice><type>{TYPES[duration]}</type>')
+    if duration == 12:
+        xml.append('<dot/>')
+    if stem:
+        xml.append(f'<stem>{stem}</stem>')
+    xml.append(f'<staff>{staff}</staff>')
+    if beam:
+        xml.append(f'<beam number="1">{beam}</beam>')
+    if tie:
+        xml.append(f'<notations><tied type="{tie}"/></notations>')
+    xml.append('</note>')
+    return '\n'.join(xml)
+
+def voice_xml(r, voice, staff, voices_in_staff, chord_density, staff_crossing):
+    octave = 5 if staff == 1 else 3
+    stem = 'up' if (voice - 1) % 4 % 2 == 0 else 'down'
+    xml = []
+    rhythm = r.choice(RHYTHMS)
+    for i, duration in enumerate(rhythm):
+        note_staff = 3 - staff if r.random() < staff_crossing else staff
+        if r.random() < 0.1:
+            xml.append(note_xml(None, None, None, duration, voice, note_staff, rest=True))
+            continue
+        beam = None
+        if duration <= 2:
+            beam = 'begin' if i == 0 or rhythm[i - 1] > 2 else ('end' if i + 1 == len(rhythm) or rhythm[i + 1] > 2 else 'continue')
+        step, alter = r.choice(STEPS), r.choice([0, 0, 0, 1, -1])
+        xml.append(note_xml(step, octave + r.randint(-1, 0), alter, duration, voice, note_staff, stem=stem if voices_in_staff > 1 or r.random() < 0.5 else 'down', beam=beam))
+        if r.random() < chord_density:
+            for _ in range(r.randint(1, 3)):
+                xml.append(note_xml(r.choice(STEPS), octave + r.randint(-1, 1), 0, duration, voice, note_staff, chord=True))
+    return xml
+
+def synthetic_piano_score(measures=100, voices=2, chord_density=0.3, staff_crossing=0.0, seed=0): # one-part, two-staff piano MusicXML (str)
+    r = random.Random(seed)
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+           '<score-partwise version="3.1">',
+           '<part-list><score-part id="P1"><part-name>Piano</part-name></score-part></part-list>',
+           '<part id="P1">']
+    for number in range(1, measures + 1):
+        xml.append(f'<measure number="{number}">')
+        if number == 1 or r.random() < 0.02:
+            fifths = r.randint(-7, 7)
+            xml.append(f'<attributes><divisions>{DIVISIONS}</divisions><key><fifths>{fifths}</fifths></key><time><beats>4</beats><beat-type>4</beat-type></time><staves>2</staves>'
+                       '<clef number="1"><sign>G</sign><line>2</line></clef><clef number="2"><sign>F</sign><line>4</line></clef></attributes>')
+        for staff in (1, 2):
+            if staff == 2:
+                xml.append(f'<backup><duration>{MEASURE_LENGTH}</duration></backup>')
+            # the number of voices varies from measure to measure, up to 'voices'
+            voices_in_staff = r.randint(1, voices) if voices > 1 and r.random() < 0.3 else voices
+            for v in range(voices_in_staff):
+                if v > 0:
+                    xml.append(f'<backup><duration>{MEASURE_LENGTH}</duration></backup>')
+                xml += voice_xml(r, v + 1 + 4 * (staff - 1), staff, voices_in_staff, chord_density, staff_crossing)
+            xml.append(f'<direction placement="below"><direction-type><dynamics><mf/></dynamics></direction-type><staff>{staff}</staff></direction>')
+        xml.append('</measure>')
+    xml += ['</part>', '</score-partwise>']
+    return '\n'.join(xml) + '\n'
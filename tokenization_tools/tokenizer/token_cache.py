@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+from score_to_tokens import TOKENIZER_VERSION, stream_MusicXML_to_tokens
+
+def read_score_bytes(source): # path, '-' (stdin), bytes or binary file-like object -> raw bytes of the score file
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    if source == '-':
+        return sys.stdin.buffer.read()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return f.read()
+    return getattr(source, 'buffer', source).read()
+
+class TokenCache: # on-disk cache of token sequences, keyed on score content, 'note_name' and TOKENIZER_VERSION
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.entries())
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def key(self, data, note_name=True):
+        content = hashlib.sha256(data).hexdigest()
+        return hashlib.sha256(f'v{TOKENIZER_VERSION}:note_name={bool(note_name)}:{content}'.encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def entries(self): # (last access, size, path) of all cached sequences
+        for root, _, files in os.walk(self.cache_dir):
+            for f in files:
+                if f.endswith('.json'):
+                    path = os.path.join(root, f)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError: # evicted by another process
+                        continue
+                    yield stat.st_mtime, stat.st_size, path
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                tokens = json.load(f)
+            os.utime(path) # mtime is the last access time for LRU eviction
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return tokens
+
+    def put(self, key, tokens):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(tokens, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        try:
+            replaced = os.stat(path).st_size # an entry overwritten under the same key
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp_path, path) # atomic, so concurrent readers never see a partial entry
+        self.size += len(data) - replaced
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self): # remove least recently used entries until the cache fits in max_bytes
+        entries = sorted(self.entries())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def tokenize(self, source, note_name=True): # MusicXML_to_tokens with the cache in front
+        data = read_score_bytes(source)
+        key = self.key(data, note_name)
+        tokens = self.get(key)
+        if tokens is None:
+            tokens = stream_MusicXML_to_tokens(data, note_name=note_name)
+            self.put(key, tokens)
+        return tokens
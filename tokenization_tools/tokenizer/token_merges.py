@@ -0,0 +1,142 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from packed_corpus import PackedCorpus, PackedCorpusWriter
+from vocabulary import SPECIAL_TOKENS, Vocabulary, default_vocabulary
+
+MERGE_SEPARATOR = '+' # 'len_1/2+stem_up+beam_continue'; expanded by merged_to_regular in the detokenizer
+
+def is_barrier(token): # tokens never merged: sections, bars and voices (so staff / measure offsets and voice structure survive), padding
+    return (token in SPECIAL_TOKENS and token != 'rest') or token.startswith('part_')
+
+def merge_pair(ids, a, b, merged): # replace each adjacent (a, b) by 'merged', left to right without overlaps
+    hits = np.flatnonzero((ids[:-1] == a) & (ids[1:] == b))
+    if a == b and len(hits): # runs like 'a a a' merge as '(a a) a'
+        run_start = np.concatenate([[True], hits[1:] != hits[:-1] + 1])
+        first = np.maximum.accumulate(np.where(run_start, hits, -1))
+        hits = hits[(hits - first) % 2 == 0]
+    if not len(hits):
+        return ids
+    ids = ids.copy()
+    ids[hits] = merged
+    return np.delete(ids, hits + 1)
+
+def learn_merges(sequences, vocabulary=None, merge_count=200, min_frequency=2, log=None): # BPE-style: repeatedly merge the most frequent adjacent pair of (possibly merged) tokens -> [(left, right), ...]
+    vocabulary = vocabulary if vocabulary is not None else default_vocabulary()
+    tokens, ids = list(vocabulary.tokens), dict(vocabulary.ids)
+    size = len(tokens) + merge_count # bound of the IDs, for pair keys
+    mergeable = np.ones(size, dtype=bool)
+    mergeable[[i for i, token in enumerate(tokens) if is_barrier(token)]] = False
+
+    # sequences are separated by padding, so no pair crosses them
+    x = np.concatenate([np.append(np.asarray(s, dtype=np.int64), vocabulary.pad_id) for s in sequences]) if len(sequences) else np.zeros(0, dtype=np.int64)
+    merges = []
+    for _ in range(merge_count):
+        left, right = x[:-1], x[1:]
+        candidates = mergeable[left] & mergeable[right]
+        if not candidates.any():
+            break
+        keys, counts = np.unique(left[candidates] * size + right[candidates], return_counts=True)
+        best = int(np.argmax(counts))
+        if counts[best] < min_frequency:
+            break
+        a, b = divmod(int(keys[best]), size)
+        name = tokens[a] + MERGE_SEPARATOR + tokens[b]
+        if name not in ids:
+            ids[name] = len(tokens)
+            tokens.append(name)
+        x = merge_pair(x, a, b, ids[name])
+        merges.append((tokens[a], tokens[b]))
+        if log is not None:
+            print(f'{len(merges)}\t{name}\t{counts[best]}', file=log)
+    return merges
+
+class TokenMerges: # learned merges, applied in the order they were learned
+    def __init__(self, merges, vocabulary=None):
+        base = vocabulary if vocabulary is not None else default_vocabulary()
+        self.merges = [tuple(merge) for merge in merges]
+        tokens, ids = list(base.tokens), dict(base.ids)
+        self.rules = [] # (left ID, right ID, merged ID)
+        for a, b in self.merges:
+            name = a + MERGE_SEPARATOR + b
+            if name not in ids:
+                ids[name] = len(tokens)
+                tokens.append(name)
+            self.rules.append((ids[a], ids[b], ids[name]))
+        self.vocabulary = Vocabulary(tokens) # the base vocabulary followed by the merged tokens
+
+    def apply_ids(self, ids): # token IDs (of self.vocabulary) -> merged token IDs
+        x = np.asarray(ids)
+        for a, b, merged in self.rules:
+            x = merge_pair(x, a, b, merged)
+        return x.astype(self.vocabulary.typecode, copy=False)
+
+    def apply(self, tokens): # token strings -> merged token strings; tokens outside the vocabulary are kept as they are
+        ids, table = self.vocabulary.ids, list(self.vocabulary.tokens)
+        local = {}
+        for token in tokens:
+            if token not in ids and token not in local:
+                local[token] = len(table)
+                table.append(token)
+        x = np.array([ids[t] if t in ids else local[t] for t in tokens], dtype=np.int64)
+        for a, b, merged in self.rules:
+            x = merge_pair(x, a, b, merged)
+        return [table[i] for i in x.tolist()]
+
+    def save(self, path): # one merge per line: 'left right'
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(''.join(f'{a} {b}\n' for a, b in self.merges))
+
+    @classmethod
+    def load(cls, path, vocabulary=None):
+        with open(path, encoding='utf-8') as f:
+            return cls([line.split(' ') for line in f.read().splitlines() if line], vocabulary)
+
+def length_report(sequences, merges): # (tokens before, tokens after) of applying 'merges' to ID sequences
+    before = after = 0
+    for ids in sequences:
+        before += len(ids)
+        after += len(merges.apply_ids(ids))
+    return before, after
+
+def apply_to_corpus(corpus, merges, out_path): # packed corpus -> packed corpus of merged token IDs (same sequences, staves and measures)
+    with PackedCorpusWriter(out_path, merges.vocabulary, staves=corpus.staff_names) as writer:
+        for name, ids in zip(corpus.names, corpus):
+            writer.add_ids(name, merges.apply_ids(ids))
+        return len(corpus.tokens), writer.sequences[-1]
+
+def report(before, after, log=sys.stderr):
+    print(f'{before} -> {after} tokens ({100 * (1 - after / max(before, 1)):.1f}% shorter)', file=log)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Learn compound-token merges from a packed corpus, or apply them to one, and report the sequence length reduction.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    learn = commands.add_parser('learn', help='learn merges from a packed corpus (packed_corpus.py)')
+    learn.add_argument('corpus', help='packed corpus directory')
+    learn.add_argument('-o', '--out', required=True, help='merges file (one "left right" pair per line)')
+    learn.add_argument('-n', '--merges', type=int, default=200, help='number of merges to learn (default: 200)')
+    learn.add_argument('--min-frequency', type=int, default=2, help='stop when the most frequent pair occurs less often (default: 2)')
+    learn.add_argument('--eval', default=None, help='packed corpus to report the length reduction on (default: the training corpus)')
+    learn.add_argument('-v', '--verbose', action='store_true', help='print every merge with its count')
+    apply = commands.add_parser('apply', help='write a packed corpus of merged token IDs')
+    apply.add_argument('corpus', help='packed corpus directory')
+    apply.add_argument('merges', help='merges file')
+    apply.add_argument('-o', '--out', required=True, help='output packed corpus directory')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    corpus = PackedCorpus(args.corpus)
+    if args.command == 'learn':
+        merges = TokenMerges(learn_merges(list(corpus), corpus.vocabulary, args.merges, args.min_frequency, sys.stderr if args.verbose else None), corpus.vocabulary)
+        merges.save(args.out)
+        print(f'{len(merges.merges)} merges learned in {time.perf_counter() - start:.1f} s', file=sys.stderr)
+        report(*length_report(PackedCorpus(args.eval) if args.eval else corpus, merges))
+    else:
+        report(*apply_to_corpus(corpus, TokenMerges.load(args.merges, corpus.vocabulary), args.out))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
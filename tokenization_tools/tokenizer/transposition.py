@@ -0,0 +1,91 @@
+import re
+
+import numpy as np
+
+from vocabulary import default_vocabulary
+
+LETTERS_BY_FIFTHS = 'FCGDAEB' # line of fifths, F = -1
+STEP_TO_FIFTHS = {step: i - 1 for i, step in enumerate(LETTERS_BY_FIFTHS)}
+STEP_TO_SEMITONE = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+MIDI_NOTE = re.compile(r'note_(-?\d+)$')
+KEY = re.compile(r'key_(flat|sharp|natural)_(\d+)$')
+PIANO_RANGE = (21, 108) # A0 - C8
+MAX_ALTER = 2
+MAX_FIFTHS = 7 # key signatures
+
+def key_fifths(token): # 'key_flat_3' -> -3 (None if not a key token)
+    match = KEY.match(token) if isinstance(token, str) else None
+    if match is None:
+        return None
+    return -int(match.group(2)) if match.group(1) == 'flat' else int(match.group(2))
+
+def normalized_fifths(fifths): # enharmonic key signature with at most 6 flats / 5 sharps
+    return (fifths + 6) % 12 - 6
+
+def transpose_spelling(step, alter, octave, semitones, fifths): # move a spelled pitch by an interval of 'fifths' on the line of fifths and 'semitones'
+    position = STEP_TO_FIFTHS[step] + 7 * alter + fifths
+    new_step, new_alter = LETTERS_BY_FIFTHS[(position + 1) % 7], (position + 1) // 7
+    midi = 12 * (octave + 1) + STEP_TO_SEMITONE[step] + alter + semitones
+    return new_step, new_alter, (midi - STEP_TO_SEMITONE[new_step] - new_alter) // 12 - 1, midi
+
+class Transposer: # transpose token ID sequences with one lookup table per (semitones, spelling interval)
+    def __init__(self, vocabulary=None, pitch_range=PIANO_RANGE):
+        self.vocabulary = vocabulary if vocabulary is not None else default_vocabulary()
+        self.pitch_range = pitch_range
+        self.tables = {}
+
+        self.spelled = {} # ID -> (step, alter, octave) of note name tokens
+        for (step, alter, octave), id_ in self.vocabulary.pitch_ids[True].items():
+            if id_ != self.vocabulary.unk_id:
+                self.spelled[id_] = (step, int(alter or 0), int(octave))
+        self.spelled_ids = {}
+        for id_, (step, alter, octave) in self.spelled.items():
+            self.spelled_ids[step, alter, octave] = id_
+
+        self.key_ids = np.array([i for i, token in enumerate(self.vocabulary.tokens) if key_fifths(token) is not None], dtype=np.int64)
+
+    def first_key(self, ids): # fifths of the first key signature (C major if none)
+        keys = np.flatnonzero(np.isin(ids, self.key_ids))
+        return key_fifths(self.vocabulary.tokens[ids[keys[0]]]) if len(keys) else 0
+
+    def spelling_interval(self, key, semitones): # fifths moved by the key signature 'key', which is renormalized unless not transposed
+        return normalized_fifths(key + 7 * semitones) - key if semitones else 0
+
+    def table(self, semitones, fifths): # token ID -> transposed token ID, -1 where the result is out of range or not in the vocabulary
+        key = (semitones, fifths)
+        if key in self.tables:
+            return self.tables[key]
+
+        vocabulary, low, high = self.vocabulary, *self.pitch_range
+        table = np.arange(len(vocabulary), dtype=np.int64)
+        for id_, token in enumerate(vocabulary.tokens):
+            if id_ in self.spelled:
+                step, alter, octave, midi = transpose_spelling(*self.spelled[id_], semitones, fifths)
+                valid = abs(alter) <= MAX_ALTER and low <= midi <= high
+                table[id_] = self.spelled_ids.get((step, alter, octave), -1) if valid else -1
+                continue
+            match = MIDI_NOTE.match(token) if isinstance(token, str) else None
+            if match:
+                midi = int(match.group(1)) + semitones
+                table[id_] = vocabulary.ids.get(f'note_{midi}', -1) if low <= midi <= high else -1
+                continue
+            key_signature = key_fifths(token)
+            if key_signature is not None:
+                new_key = key_signature + fifths
+                table[id_] = vocabulary.ids.get(f'key_{"flat" if new_key < 0 else "sharp" if new_key > 0 else "natural"}_{abs(new_key)}', -1) if abs(new_key) <= MAX_FIFTHS else -1
+        self.tables[key] = table
+        return table
+
+    def transpose(self, ids, semitones): # transposed IDs, or None if any pitch / key leaves the range
+        return self.augment(ids, [semitones]).get(semitones)
+
+    def augment(self, ids, semitones=range(-5, 7)): # {semitones: transposed IDs} for every transposition that stays in range
+        ids = np.asarray(ids)
+        semitones = list(semitones)
+        if not len(ids) or not semitones:
+            return {s: ids.copy() for s in semitones}
+        key = self.first_key(ids)
+        tables = np.stack([self.table(s, self.spelling_interval(key, s)) for s in semitones])
+        transposed = tables[:, ids] # all transpositions in one gather
+        valid = (transposed >= 0).all(axis=1)
+        return {s: row.astype(ids.dtype) for s, row, ok in zip(semitones, transposed, valid) if ok}
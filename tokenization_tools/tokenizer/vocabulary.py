@@ -0,0 +1,129 @@
+from array import array
+from fractions import Fraction
+import functools
+import itertools
+
+from score_to_tokens import beams_to_token, clef_to_token, duration_to_token, iter_MusicXML_tokens, key_to_token, pitch_to_token, time_to_token
+
+SPECIAL_TOKENS = ['<pad>', '<unk>', 'R', 'L', 'bar', '<voice>', '</voice>', 'rest']
+STEPS = 'CDEFGAB'
+ALTERS = (None, '-2', '-1', '0', '1', '2') # as written in <alter>
+OCTAVES = [str(octave) for octave in range(10)]
+LENGTH_DENOMINATORS = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32) # lengths are in quarter notes
+MAX_LENGTH = 16
+TIME_BEATS = range(1, 33)
+TIME_BEAT_TYPES = (1, 2, 4, 8, 16, 32)
+STEMS = ('up', 'down', 'none', 'double')
+TIES = ('start', 'stop')
+BEAM_VALUES = ('begin', 'continue', 'end', 'forward hook', 'backward hook')
+MAX_BEAMS = 4 # beam levels of a note (64th notes)
+MAX_PARTS = 32 # section tokens of scores other than piano
+MAX_PART_STAVES = 4
+
+def build_vocabulary(): # the fixed token list; IDs are positions in it
+    tokens = list(SPECIAL_TOKENS)
+    tokens += [clef_to_token(sign) for sign in 'GF']
+    tokens += [key_to_token(key) for key in range(-7, 8)]
+    tokens += [time_to_token([beats, beat_type]) for beat_type in TIME_BEAT_TYPES for beats in TIME_BEATS if beat_type <= 4 or beats % beat_type] # time_to_token does not handle e.g. 8/8
+    for note_name in (True, False):
+        tokens += [pitch_to_token(pitch, note_name) for pitch in itertools.product(STEPS, ALTERS, OCTAVES)]
+    lengths = sorted({Fraction(n, d) for d in LENGTH_DENOMINATORS for n in range(1, MAX_LENGTH * d + 1)})
+    tokens += [f'len_{length}' for length in lengths]
+    tokens += [f'stem_{stem}' for stem in STEMS]
+    tokens += [beams_to_token(beams) for beams in beam_combinations()]
+    tokens += [f'tie_{tie}' for tie in TIES]
+    for part in range(1, MAX_PARTS + 1):
+        tokens += [f'part_{part}'] + [f'part_{part}_staff_{staff}' for staff in range(1, MAX_PART_STAVES + 1)]
+    return list(dict.fromkeys(tokens)) # note names / MIDI numbers with the same spelling appear once
+
+def beam_combinations(): # all <beam> value tuples up to MAX_BEAMS levels
+    for levels in range(1, MAX_BEAMS + 1):
+        yield from itertools.product(BEAM_VALUES, repeat=levels)
+
+class Vocabulary: # token <-> ID mapping, with lookup tables from note elements straight to IDs
+    def __init__(self, tokens=None):
+        self.tokens = list(tokens) if tokens is not None else build_vocabulary()
+        self.ids = {token: i for i, token in enumerate(self.tokens)}
+        if len(self.ids) != len(self.tokens):
+            raise ValueError('duplicate tokens in the vocabulary')
+        self.typecode = 'H' if len(self.tokens) <= 1 << 16 else 'I' # array / numpy typecode of ID buffers
+
+        self.pad_id, self.unk_id = self.ids['<pad>'], self.ids['<unk>']
+        self.bar_id, self.rest_id = self.ids.get('bar'), self.ids.get('rest') # other vocabularies (e.g. MIDI input tokens) may lack score tokens
+        self.voice_start_id, self.voice_end_id = self.ids.get('<voice>'), self.ids.get('</voice>')
+
+        # (step, alter, octave), <stem>, <beam> values and tie type -> ID; durations depend on <divisions>, so that table is filled as they are met
+        self.pitch_ids = {note_name: {pitch: self.id(pitch_to_token(pitch, note_name)) for pitch in itertools.product(STEPS, ALTERS, OCTAVES)} for note_name in (True, False)}
+        self.duration_ids = {}
+        self.stem_ids = {stem: self.id(f'stem_{stem}') for stem in STEMS}
+        self.beam_ids = {beams: self.id(beams_to_token(beams)) for beams in beam_combinations()}
+        self.tie_ids = {tie: self.id(f'tie_{tie}') for tie in TIES}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def id(self, token): # unknown tokens map to '<unk>'
+        return self.ids.get(token, self.unk_id)
+
+    def new_buffer(self, ids=()):
+        return array(self.typecode, ids)
+
+    def encode(self, tokens):
+        return self.new_buffer([self.id(token) for token in tokens])
+
+    def decode(self, ids):
+        return [self.tokens[i] for i in ids]
+
+    def note_ids(self, note, divisions=8, note_name=True): # note_element_to_tokens, as IDs
+        if note.duration is None: # gracenote
+            return ()
+
+        key = (note.duration, divisions)
+        length = self.duration_ids.get(key)
+        if length is None:
+            length = self.duration_ids[key] = self.id(duration_to_token(*key))
+
+        if note.rest:
+            return (self.rest_id, length)
+
+        pitch_ids, ids = self.pitch_ids[bool(note_name)], []
+        for pitch in note.pitches:
+            ids.append(pitch_ids[pitch] if pitch in pitch_ids else self.id(pitch_to_token(tuple(pitch), note_name)))
+        ids.append(length)
+
+        if note.stem is not None:
+            ids.append(self.stem_ids[note.stem] if note.stem in self.stem_ids else self.id(f'stem_{note.stem}'))
+
+        if note.beams:
+            beams = tuple(note.beams)
+            ids.append(self.beam_ids[beams] if beams in self.beam_ids else self.id(beams_to_token(beams)))
+
+        if note.tie is not None:
+            ids.append(self.tie_ids[note.tie] if note.tie in self.tie_ids else self.id('tie_' + note.tie))
+
+        return ids
+
+    def save(self, path): # one token per line
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.tokens) + '\n')
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(f.read().splitlines())
+
+@functools.lru_cache(maxsize=None)
+def default_vocabulary():
+    return Vocabulary()
+
+def MusicXML_to_ids(source, note_name=True, vocabulary=None): # MusicXML_to_tokens as an array of token IDs, without building the token strings
+    vocabulary = vocabulary if vocabulary is not None else default_vocabulary()
+    staves = {}
+    for measure in iter_MusicXML_tokens(source, note_name, vocabulary):
+        if measure.staff not in staves:
+            staves[measure.staff] = vocabulary.new_buffer([vocabulary.id(measure.staff)])
+        staves[measure.staff].extend(measure.tokens)
+    ids = vocabulary.new_buffer()
+    for staff_ids in staves.values():
+        ids.extend(staff_ids)
+    return ids
@@ -0,0 +1,109 @@
+import itertools
+from collections import deque, namedtuple
+
+from score_to_tokens import iter_MusicXML_measures, iter_score_tokens
+
+STATE_KINDS = ('clef', 'key', 'time') # carried over to window starts
+
+# measures [start, end) of a score (positions from 0) in MusicXML_to_tokens format
+Window = namedtuple('Window', ['start', 'end', 'numbers', 'tokens'])
+
+def token_kind(token): # 'clef', 'key', 'time' or None
+    kind = token.split('_', 1)[0] if isinstance(token, str) else None
+    return kind if kind in STATE_KINDS else None
+
+def iter_measure_columns(source, note_name=True): # yield [MeasureTokens of each staff] per measure position; lazy for one-part scores, other scores are buffered
+    measures = iter_MusicXML_measures(source)
+    first = next(measures, None)
+    if first is None:
+        return
+    tokens = iter_score_tokens(itertools.chain([first], measures), note_name)
+    if first.part_count <= 1:
+        yield from staff_columns(tokens)
+        return
+    parts = [list(staff_columns(part)) for _, part in itertools.groupby(tokens, key=lambda m: m.part)]
+    for column in itertools.zip_longest(*parts, fillvalue=[]):
+        yield [measure for part in column for measure in part]
+
+def staff_columns(measures): # MeasureTokens of one part (staves of a measure in a row) -> lists of them per measure
+    column = []
+    for measure in measures:
+        if column and measure.staff == column[0].staff:
+            yield column
+            column = []
+        column.append(measure)
+    if column:
+        yield column
+
+def update_state(state, tokens): # active clef / key / time tokens of a staff after 'tokens'; the dict keeps the order the staff first set them in
+    for token in tokens:
+        kind = token_kind(token)
+        if kind is not None:
+            state[kind] = token
+
+def carried_tokens(state, tokens): # state tokens to insert after the 'bar' of a window's first measure (those the measure does not set itself), in the staff's own order
+    leading = set()
+    for token in tokens[1:]:
+        kind = token_kind(token)
+        if kind is None:
+            break
+        leading.add(kind)
+    return [token for kind, token in state.items() if kind not in leading]
+
+def window_tokens(columns, states): # columns of a window and the states before its first one -> token sequence
+    staves = {}
+    for column in columns:
+        for measure in column:
+            if measure.staff not in staves:
+                staves[measure.staff] = [measure.staff]
+                if measure.tokens:
+                    staves[measure.staff] += measure.tokens[:1] + carried_tokens(states.get(measure.staff, {}), measure.tokens) + measure.tokens[1:]
+                continue
+            staves[measure.staff] += measure.tokens
+    return [token for staff_tokens in staves.values() for token in staff_tokens]
+
+def iter_windows(columns, max_tokens, overlap=0): # measure columns -> Windows of at most 'max_tokens' tokens per staff, consecutive windows sharing 'overlap' measures
+    columns = iter(columns)
+    pending = deque() # (position, column, states before it) from the current window start on
+    states = {} # staff -> {kind: token} after the last read column
+    position = 0
+
+    def read():
+        nonlocal position
+        column = next(columns, None)
+        if column is None:
+            return False
+        pending.append((position, column, {staff: dict(state) for staff, state in states.items()}))
+        for measure in column:
+            update_state(states.setdefault(measure.staff, {}), measure.tokens)
+        position += 1
+        return True
+
+    while pending or read():
+        start, first, first_states = pending[0]
+        sizes = {measure.staff: 1 + len(measure.tokens) + len(carried_tokens(first_states.get(measure.staff, {}), measure.tokens)) for measure in first}
+        if max(sizes.values(), default=0) > max_tokens: # a measure that does not fit any window
+            pending.popleft()
+            continue
+
+        count = 1
+        while count < len(pending) or read():
+            column = pending[count][1]
+            grown = dict(sizes)
+            for measure in column:
+                grown[measure.staff] = grown.get(measure.staff, 1) + len(measure.tokens)
+            if max(grown.values()) > max_tokens:
+                break
+            sizes, count = grown, count + 1
+
+        window = [pending[i] for i in range(count)]
+        yield Window(start, start + count, [column[0].number if column else None for _, column, _ in window],
+                     window_tokens([column for _, column, _ in window], first_states))
+
+        if count == len(pending) and not read(): # the last window reached the end of the score
+            return
+        for _ in range(max(1, count - overlap)):
+            pending.popleft()
+
+def iter_MusicXML_windows(source, max_tokens=1024, overlap=0, note_name=True): # lazily yield measure-aligned Windows of a score (see iter_windows)
+    return iter_windows(iter_measure_columns(source, note_name), max_tokens, overlap)
@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from multiprocessing import Pool
+
+from batch_tokenize import DONE, FAILED, MANIFEST_NAME, SKIPPED, find_scores, init_worker, tokenize_file
+from latency import latency_summary
+from packed_corpus import pack_corpus
+
+# files of a queue directory (on a filesystem shared by all nodes; only atomic create / rename / link are relied upon)
+TASKS_NAME = 'tasks.json' # [[path, ...], ...]; written once
+CLAIMS_DIR = 'claims' # 'task-XXXXX' while a node works on a task; its mtime is the lease heartbeat
+SHARD_NAME = 'shard-{:05d}.txt' # token lines of a task, as written by batch_tokenize.py
+TASK_MANIFEST_NAME = 'task-{:05d}.jsonl' # manifest entries of a task; written last, marks the task as done
+
+def init_queue(inputs, queue_dir, task_size=100): # split the scores into tasks; the first node to get there wins, others reuse its tasks
+    tasks_path = os.path.join(queue_dir, TASKS_NAME)
+    if not os.path.exists(tasks_path):
+        paths = find_scores(inputs)
+        os.makedirs(os.path.join(queue_dir, CLAIMS_DIR), exist_ok=True)
+        tmp_path = f'{tasks_path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump([paths[i:i + task_size] for i in range(0, len(paths), task_size)], f, ensure_ascii=False)
+        try:
+            os.link(tmp_path, tasks_path) # fails if another node created the tasks first
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    return read_tasks(queue_dir)
+
+def read_tasks(queue_dir):
+    with open(os.path.join(queue_dir, TASKS_NAME), encoding='utf-8') as f:
+        return json.load(f)
+
+def task_done(queue_dir, task):
+    return os.path.exists(os.path.join(queue_dir, TASK_MANIFEST_NAME.format(task)))
+
+class Lease: # exclusive claim on one task, kept alive by a heartbeat thread
+    def __init__(self, queue_dir, task, owner, seconds):
+        self.path = os.path.join(queue_dir, CLAIMS_DIR, f'task-{task:05d}')
+        self.owner, self.seconds = owner, seconds
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def acquire(self): # True if this node now holds the task
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return self.break_expired() and self.acquire()
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.owner)
+        self.thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.thread.start()
+        return True
+
+    def break_expired(self): # remove an expired claim; the O_EXCL marker named after its mtime lets only one node break each stale claim
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return True # released in the meantime
+        if time.time() - mtime / 1e9 < self.seconds:
+            return False
+        try:
+            os.close(os.open(f'{self.path}.broken-{mtime}', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False # another node is taking it over
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def heartbeat(self):
+        while not self.stopped.wait(self.seconds / 3):
+            try:
+                if not self.held():
+                    raise FileNotFoundError(self.path)
+                os.utime(self.path)
+            except FileNotFoundError: # taken over by another node
+                self.lost = True
+                return
+
+    def held(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return f.read() == self.owner
+        except FileNotFoundError:
+            return False
+
+    def release(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.held():
+            os.remove(self.path)
+
+def write_atomic(path, text): # readers see the whole file or nothing
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def run_task(queue_dir, task, paths, pool, lease, note_name=True): # tokenize one task; False if the lease was lost before it was committed
+    shard = SHARD_NAME.format(task)
+    lines, entries, latencies = [], [], []
+    for path, status, tokens, error, seconds in pool.imap(tokenize_file, [(p, note_name) for p in paths], chunksize=1):
+        if lease.lost:
+            return False, latencies
+        if status == DONE:
+            entries.append({'path': path, 'status': DONE, 'shard': shard, 'line': len(lines), 'tokens': len(tokens), 'seconds': round(seconds, 4)})
+            lines.append(path + '\t' + ' '.join(map(str, tokens)) + '\n')
+        else:
+            entries.append({'path': path, 'status': status, 'error': error, 'seconds': round(seconds, 4)})
+        latencies.append(seconds)
+    if lease.lost:
+        return False, latencies
+    write_atomic(os.path.join(queue_dir, shard), ''.join(lines))
+    write_atomic(os.path.join(queue_dir, TASK_MANIFEST_NAME.format(task)), ''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in entries))
+    return True, latencies
+
+def run_worker(queue_dir, workers=None, lease_seconds=300, poll_seconds=5, note_name=True, cache_dir=None, cache_bytes=1 << 30, log=sys.stderr): # claim and tokenize tasks until every task is done
+    tasks = read_tasks(queue_dir)
+    owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}'
+    offset = hash(owner) % max(len(tasks), 1) # nodes start looking at different tasks
+    order = list(range(offset, len(tasks))) + list(range(offset))
+    done, latencies, start = 0, [], time.perf_counter()
+    with Pool(workers, initializer=init_worker, initargs=(cache_dir, cache_bytes)) as pool:
+        while True:
+            pending = [task for task in order if not task_done(queue_dir, task)]
+            if not pending:
+                break
+            for task in pending:
+                lease = Lease(queue_dir, task, owner, lease_seconds)
+                if task_done(queue_dir, task) or not lease.acquire():
+                    continue
+                if task_done(queue_dir, task): # finished by the node whose expired claim was just broken
+                    lease.release()
+                    continue
+                try:
+                    committed, task_latencies = run_task(queue_dir, task, tasks[task], pool, lease, note_name)
+                finally:
+                    lease.release()
+                latencies += task_latencies
+                done += committed
+                print(f"task {task}: {len(tasks[task])} files {'done' if committed else 'abandoned (lease lost)'}", file=log)
+                break
+            else: # every pending task is held by a live node: wait for them to finish or for their leases to expire
+                time.sleep(poll_seconds)
+
+    elapsed = time.perf_counter() - start
+    print(f'{done} tasks, {len(latencies)} files in {elapsed:.1f} s on this node; per-file latency: {latency_summary(latencies)}', file=log)
+    return done
+
+def queue_status(queue_dir): # (tasks, done, claimed)
+    tasks = read_tasks(queue_dir)
+    claims = [f for f in os.listdir(os.path.join(queue_dir, CLAIMS_DIR)) if f.startswith('task-') and '.' not in f]
+    return len(tasks), sum(task_done(queue_dir, task) for task in range(len(tasks))), len(claims)
+
+def merge_queue(queue_dir, out_path, partial=False, log=sys.stderr): # task manifests -> manifest.jsonl (in task order), then pack the tokens of every done piece
+    tasks = read_tasks(queue_dir)
+    missing = [task for task in range(len(tasks)) if not task_done(queue_dir, task)]
+    if missing and not partial:
+        raise RuntimeError(f'{len(missing)} of {len(tasks)} tasks are not done yet')
+
+    counts, manifest = {DONE: 0, FAILED: 0, SKIPPED: 0}, []
+    for task in range(len(tasks)):
+        if task in missing:
+            continue
+        with open(os.path.join(queue_dir, TASK_MANIFEST_NAME.format(task)), encoding='utf-8') as f:
+            for line in f:
+                counts[json.loads(line)['status']] += 1
+                manifest.append(line)
+    write_atomic(os.path.join(queue_dir, MANIFEST_NAME), ''.join(manifest))
+    print(f"{counts[DONE]} done, {counts[FAILED]} failed, {counts[SKIPPED]} skipped ({len(missing)} tasks missing)", file=log)
+    pack_corpus([queue_dir], out_path, log=log)
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Tokenize a corpus on several machines sharing a directory: tasks are claimed with atomic claim files and leases.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    init = commands.add_parser('init', help='split the scores into tasks (once; later calls reuse them)')
+    init.add_argument('queue_dir')
+    init.add_argument('inputs', nargs='+', help='score files, directories or zip archives of scores')
+    init.add_argument('--task-size', type=int, default=100, help='scores per task (default: 100)')
+    work = commands.add_parser('work', help='claim and tokenize tasks until all are done (run on every node)')
+    work.add_argument('queue_dir')
+    work.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    work.add_argument('--lease', type=float, default=300, help='seconds without a heartbeat after which a claim is taken over (default: 300)')
+    work.add_argument('--poll', type=float, default=5, help='seconds between looks at tasks held by other nodes (default: 5)')
+    work.add_argument('--midi-number', action='store_true', help='emit MIDI note numbers instead of note names')
+    work.add_argument('--cache-dir', default=None, help='reuse tokens of unchanged scores from this on-disk cache')
+    work.add_argument('--cache-size', type=int, default=1024, help='cache size limit in MB')
+    status = commands.add_parser('status', help='print the number of tasks, done tasks and claimed tasks')
+    status.add_argument('queue_dir')
+    merge = commands.add_parser('merge', help='pack the tokens of all tasks into a packed corpus')
+    merge.add_argument('queue_dir')
+    merge.add_argument('-o', '--out', required=True, help='packed corpus directory')
+    merge.add_argument('--partial', action='store_true', help='merge even if some tasks are not done')
+    args = parser.parse_args(argv)
+
+    if args.command == 'init':
+        tasks = init_queue(args.inputs, args.queue_dir, args.task_size)
+        print(f'{len(tasks)} tasks, {sum(map(len, tasks))} scores', file=sys.stderr)
+    elif args.command == 'work':
+        run_worker(args.queue_dir, args.workers, args.lease, args.poll, not args.midi_number, args.cache_dir, args.cache_size << 20)
+    elif args.command == 'status':
+        print('{} tasks, {} done, {} claimed'.format(*queue_status(args.queue_dir)))
+    else:
+        counts = merge_queue(args.queue_dir, args.out, args.partial)
+        return 1 if counts[FAILED] else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())